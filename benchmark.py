@@ -0,0 +1,165 @@
+import argparse
+import multiprocessing
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+
+import numpy as np
+
+from common.snapshot import read_snapshot
+from loader import MovieLensLoader
+from recs import RecommenderEngine, SVDBasedCF
+from recs.factorization import SparseSVDFactorization, ScipySVDSFactorization, RandomizedSVDFactorization, \
+    reconstruction_error
+from recs.matrix_builder import MatrixBuilder
+from recs.mips_index import IVFIndex
+
+
+def load_engine(re, args):
+    ldr = MovieLensLoader(args.data, args.clip, cache=True)
+    for chunk in ldr.get_record_columns():
+        re.add_data_columns(chunk)
+    return re
+
+
+def bench_mips(args):
+    """
+    Compares top-N retrieval through IVF index against exact scan of all items.
+    Recall is computed by scores (not ids), because many items have tied scores.
+    """
+    re = load_engine(SVDBasedCF(args.components, args.include_avg_rating), args)
+    re.build()
+    np.random.seed(42)
+    users = np.random.choice(list(re.user_vectors.keys()), min(args.queries, len(re.user_vectors)), replace=False)
+    vectors = re.index_vectors()
+
+    def scores(user_id, item_ids):
+        return vectors[[re.item_col_index[x] for x in item_ids]].dot(re.index_query(user_id))
+
+    started = time.time()
+    exact = {u: re.predict_interests(u, args.n) for u in users}
+    exact_time = (time.time() - started) / len(users)
+    print("Exact: %.3f ms/query" % (exact_time * 1000))
+
+    index = IVFIndex(args.n_lists)
+    started = time.time()
+    index.build(vectors)
+    print("IVF with %d lists built in %.2f s" % (len(index.centroids), time.time() - started))
+    re.item_index = index
+    for n_probe in args.n_probe:
+        index.n_probe = n_probe
+        started = time.time()
+        approx = {u: re.predict_interests(u, args.n) for u in users}
+        approx_time = (time.time() - started) / len(users)
+        recall = []
+        for u in users:
+            threshold = np.min(scores(u, exact[u])) if len(exact[u]) > 0 else -np.inf
+            recall.append(np.mean(scores(u, approx[u]) >= threshold - 1e-9) if len(approx[u]) > 0 else 1.0)
+        print("IVF n_probe=%d: recall@%d %.4f, %.3f ms/query (%.1fx)" %
+              (n_probe, args.n, np.mean(recall), approx_time * 1000, exact_time / approx_time))
+
+
+def bench_svd(args):
+    """
+    Reports build time and reconstruction error of each factorization backend on item-demeaned rating matrix
+    """
+    re = load_engine(RecommenderEngine(), args)
+    matrix = MatrixBuilder.from_interactions(re.interactions, MatrixBuilder.CORRECTION_ITEM_MEAN).tocsc()
+    print("Matrix %d x %d, %d non-zeros" % (matrix.shape[0], matrix.shape[1], matrix.nnz))
+    backends = [
+        ("sparsesvd", SparseSVDFactorization()),
+        ("scipy svds", ScipySVDSFactorization()),
+        ("randomized", RandomizedSVDFactorization()),
+        ("randomized, %d threads" % args.n_jobs, RandomizedSVDFactorization(n_jobs=args.n_jobs)),
+    ]
+    for components in args.components:
+        for name, backend in backends:
+            started = time.time()
+            factors = backend.factorize(matrix, components)
+            elapsed = time.time() - started
+            print("%s (%d components): %.2f s, relative reconstruction error %.5f" %
+                  (name, components, elapsed, reconstruction_error(matrix, factors)))
+
+
+def _load_client(job):
+    url, users, duration, seed = job
+    rng = random.Random(seed)
+    requests, errors = 0, 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen("%s/rest/%s/recommend" % (url, rng.choice(users))).read()
+            requests += 1
+        except Exception:
+            errors += 1
+    return requests, errors
+
+
+def bench_load(args):
+    """
+    Starts server.py with different number of workers (model is mapped from snapshot) and measures
+    throughput of /recommend endpoint under load from <clients> client processes
+    """
+    state, _ = read_snapshot(args.snapshot, verify=False)
+    users = random.Random(42).sample(state["interactions.user_ids"].tolist(), 1000)
+    url = "http://127.0.0.1:%d" % args.port
+    for workers in args.workers:
+        server = subprocess.Popen([sys.executable, "server.py", "--port", str(args.port),
+                                   "--snapshot", args.snapshot, "--workers", str(workers)])
+        try:
+            deadline = time.time() + args.startup_timeout
+            while True:
+                try:
+                    urllib.request.urlopen(url + "/rest/stats").read()
+                    break
+                except Exception:
+                    if time.time() > deadline or server.poll() is not None:
+                        raise RuntimeError("Server has not started")
+                    time.sleep(0.5)
+            pool = multiprocessing.Pool(args.clients)
+            results = pool.map(_load_client, [(url, users, args.duration, i) for i in range(args.clients)])
+            pool.close()
+            requests = sum([x[0] for x in results])
+            errors = sum([x[1] for x in results])
+            print("%d workers: %.1f requests/s (%d errors)" % (workers, requests / args.duration, errors))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Performance benchmarks")
+    parser.add_argument("--data", default="data/movielens/", help="Path to MovieLens dataset")
+    parser.add_argument("--clip", type=int, default=500000, help="Number of ratings to load")
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    mips = subparsers.add_parser("mips", help="Recall and latency of approximate top-N retrieval for SVD")
+    mips.add_argument("--components", type=int, default=70)
+    mips.add_argument("--include_avg_rating", action="store_true")
+    mips.add_argument("--n", type=int, default=10, help="Number of recommendations")
+    mips.add_argument("--queries", type=int, default=1000, help="Number of users to query")
+    mips.add_argument("--n_lists", type=int, default=None)
+    mips.add_argument("--n_probe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    mips.set_defaults(func=bench_mips)
+
+    svd = subparsers.add_parser("svd", help="Build time and reconstruction error of SVD backends")
+    svd.add_argument("--components", type=int, nargs="+", default=[10, 70, 175])
+    svd.add_argument("--n_jobs", type=int, default=4, help="Threads for parallel randomized SVD")
+    svd.set_defaults(func=bench_svd)
+
+    load = subparsers.add_parser("load", help="Throughput of /recommend endpoint depending on number of workers")
+    load.add_argument("--snapshot", required=True, help="Snapshot for server.py (see server.py --snapshot)")
+    load.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    load.add_argument("--clients", type=int, default=16, help="Number of client processes")
+    load.add_argument("--duration", type=float, default=30.0, help="Seconds of load for each configuration")
+    load.add_argument("--port", type=int, default=5757)
+    load.add_argument("--startup_timeout", type=float, default=300.0)
+    load.set_defaults(func=bench_load)
+
+    (args) = parser.parse_args()
+    if args.benchmark is None:
+        parser.print_help()
+    else:
+        args.func(args)
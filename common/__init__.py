@@ -1,5 +1,7 @@
 from typing import List
 
+import numpy as np
+
 
 class Item:
     def __init__(self, item_id: str, name: str, genres: List[str]):
@@ -22,5 +24,25 @@ class ItemRating:
         return "User %s rated %s (%d)" % (self.user_id, self.item_id, self.rating)
 
 
+class RatingColumns:
+    """
+    Chunk of rating events in columnar form: string arrays of user and item ids, float32 ratings, int64 timestamps.
+    Lets loaders stream large datasets without creating ItemRating object per event.
+    """
+    def __init__(self, user_ids: np.ndarray, item_ids: np.ndarray, ratings: np.ndarray, timestamps: np.ndarray):
+        self.user_ids = user_ids
+        self.item_ids = item_ids
+        self.ratings = ratings
+        self.timestamps = timestamps
+
+    @classmethod
+    def from_lists(cls, user_ids: List[str], item_ids: List[str], ratings: List[float], timestamps: List[int]):
+        return cls(np.array(user_ids, dtype=str), np.array(item_ids, dtype=str),
+                   np.array(ratings, dtype=np.float32), np.array(timestamps, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.ratings)
+
+
 def avg_update(old, count, next):
     return old * (float(count) - 1) / float(count) + next / float(count)
\ No newline at end of file
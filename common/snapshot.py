@@ -0,0 +1,98 @@
+import json
+import os
+import struct
+import zlib
+from typing import Dict, Tuple
+
+import numpy as np
+
+# File layout:
+#   MAGIC (8 bytes), format version (uint32), header length (uint32), header crc32 (uint32), padding to ALIGNMENT
+#   header: JSON with metadata and array table (dtype, shape, offset, crc32 for each array)
+#   arrays: raw C-ordered bytes, each starting at ALIGNMENT boundary, so they can be memory-mapped as is
+MAGIC = b"RSSNAP\x00\x00"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREFIX = struct.Struct("<8sIII")
+
+
+class SnapshotError(Exception):
+    """
+    Snapshot is corrupted, has unsupported format, or was produced by incompatible code
+    """
+    pass
+
+
+def _aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_snapshot(path: str, arrays: Dict[str, np.ndarray], meta: dict):
+    """
+    Writes arrays and JSON-serializable metadata to file. Object arrays are not supported.
+    File is written under temporary name and renamed, so readers never see partially written snapshot.
+    """
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+    table = dict()
+    offset = 0
+    for name, array in arrays.items():
+        if array.dtype.hasobject:
+            raise SnapshotError("Array %s has object dtype" % name)
+        table[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+            "crc32": zlib.crc32(array.data) & 0xffffffff
+        }
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({"meta": meta, "arrays": table}).encode("utf-8")
+    data_start = _aligned(_PREFIX.size + len(header))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(header), zlib.crc32(header) & 0xffffffff))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + table[name]["offset"])
+            f.write(array.data)
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str, verify: bool = True, mmap: bool = True) -> Tuple[Dict[str, np.ndarray], dict]:
+    """
+    Returns arrays and metadata. With mmap=True arrays are read-only views of memory-mapped file, so pages are
+    loaded lazily and shared between processes that map the same snapshot.
+    With verify=True crc32 of every array is checked (this reads whole file).
+    """
+    with open(path, "rb") as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size:
+            raise SnapshotError("%s is truncated" % path)
+        magic, version, header_length, header_crc = _PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise SnapshotError("%s is not a snapshot" % path)
+        if version != FORMAT_VERSION:
+            raise SnapshotError("Snapshot format version %d is not supported (expected %d)" % (version, FORMAT_VERSION))
+        header = f.read(header_length)
+    if zlib.crc32(header) & 0xffffffff != header_crc:
+        raise SnapshotError("Snapshot header checksum mismatch")
+    header = json.loads(header.decode("utf-8"))
+    data_start = _aligned(_PREFIX.size + header_length)
+
+    if mmap:
+        buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    else:
+        buffer = np.fromfile(path, dtype=np.uint8)
+    arrays = dict()
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        nbytes = int(np.prod(spec["shape"])) * dtype.itemsize
+        start = data_start + spec["offset"]
+        if start + nbytes > len(buffer):
+            raise SnapshotError("Snapshot is truncated (array %s)" % name)
+        raw = buffer[start:start + nbytes]
+        if verify and zlib.crc32(raw.data) & 0xffffffff != spec["crc32"]:
+            raise SnapshotError("Checksum mismatch in array %s" % name)
+        arrays[name] = raw.view(dtype).reshape(spec["shape"])
+    return arrays, header["meta"]
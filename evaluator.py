@@ -1,11 +1,21 @@
+import multiprocessing
+
 import numpy as np
 import tqdm
 from typing import List, Dict, Callable, Tuple
-import operator
 
 from loader import Loader
 from recs.recommender_engine import RecommenderEngine
-from common import ItemRating
+from common import ItemRating, RatingColumns
+
+
+# Engine, records and scorers of running parallel evaluation; forked workers inherit them instead of pickling
+_shared_scoring = None
+
+
+def _score_shard(bounds: Tuple[int, int]) -> List[List[float]]:
+    re, columns, scorers = _shared_scoring
+    return TimeBasedEvaluator._score_records(re, columns, scorers, bounds[0], bounds[1])
 
 
 class Evaluator:
@@ -70,42 +80,102 @@ class TimeBasedEvaluator(Evaluator):
     Events are fed to recommender in time-based fashion (for each user).
     This evaluator guarantees that each user in test set will have at least one record in train set.
     """
+    # Records scored by single predict_ratings() call
+    PREDICTION_CHUNK = 4096
 
-    def __init__(self, loader: Loader, partitions: List[Tuple[str, float]]=None, allow_rs_updating:bool = False):
+    def __init__(self, loader: Loader, partitions: List[Tuple[str, float]]=None, allow_rs_updating:bool = False,
+                 n_jobs: int = 1):
         super().__init__()
         self.allow_rs_updating = allow_rs_updating
+        # Number of processes for scoring. Parallel scoring is not used with allow_rs_updating, since then every
+        # prediction depends on all previous records.
+        self.n_jobs = n_jobs
         if partitions is None:
             partitions = [("train", 0.8), ("test", 0.2)]
 
-        by_user = dict()  # type: Dict[str, List[ItemRating]]
-        # We have to load records in memory to sort
-        recs = list(loader.get_records())  # type: List[ItemRating]
-        recs.sort(key=operator.attrgetter("timestamp"))
-
-        for rec in recs:
-            if rec.user_id not in by_user:
-                by_user[rec.user_id] = []
-            by_user[rec.user_id].append(rec)
-
-        self.data_partitions = dict({p: [] for p, _ in partitions})  # type: Dict[str, List[ItemRating]]
+        # Records are kept as columns; partitions are arrays of positions in them
+        chunks = list(loader.get_record_columns())
+        self.user_ids = np.concatenate([x.user_ids for x in chunks]) if chunks else np.array([], dtype=str)
+        self.item_ids = np.concatenate([x.item_ids for x in chunks]) if chunks else np.array([], dtype=str)
+        self.ratings = np.concatenate([x.ratings for x in chunks]) if chunks else np.array([], dtype=np.float32)
+        self.timestamps = np.concatenate([x.timestamps for x in chunks]) if chunks else np.array([], dtype=np.int64)
+        n = len(self.ratings)
+
+        # Users are ordered by their first record in time, and records of each user by time
+        # (both sorts are stable, so records with equal timestamps keep loading order)
+        _, users = np.unique(self.user_ids, return_inverse=True)
+        users = users.ravel()
+        by_time = np.argsort(self.timestamps, kind="mergesort")
+        first_seen = np.full(users.max() + 1 if n > 0 else 0, n, dtype=np.int64)
+        np.minimum.at(first_seen, users[by_time], np.arange(n))
+        user_rank = first_seen[users]
+        order = np.lexsort((self.timestamps, user_rank))
+
+        # Position of each record within its user's history, and size of that history
+        sorted_users = user_rank[order]
+        group_start = np.r_[0, np.flatnonzero(np.diff(sorted_users)) + 1] if n > 0 else np.array([], dtype=np.int64)
+        group_size = np.diff(np.r_[group_start, n])
+        sizes = np.repeat(group_size, group_size).astype(np.float64)
+        rank = np.arange(n) - np.repeat(group_start, group_size)
+
+        self.partitions = dict()  # type: Dict[str, np.ndarray]
         sliding_ratio = 0.0
         for p, ratio in partitions:
-            for u, items in by_user.items():
-                from_index = int(np.ceil(len(items) * sliding_ratio))
-                to_index = int(np.floor(len(items) * (sliding_ratio+ratio)))
-                self.data_partitions[p].extend(items[from_index:to_index])
+            from_index = np.ceil(sizes * sliding_ratio)
+            to_index = np.floor(sizes * (sliding_ratio + ratio))
+            self.partitions[p] = order[(rank >= from_index) & (rank < to_index)]
             sliding_ratio += ratio
 
+    def partition_columns(self, partition: str) -> RatingColumns:
+        positions = self.partitions[partition]
+        return RatingColumns(self.user_ids[positions], self.item_ids[positions],
+                             self.ratings[positions], self.timestamps[positions])
+
     def _feed_partition(self, re: RecommenderEngine, partition: str):
-        for rec in self.data_partitions[partition]:
-            re.add_data(rec.user_id, rec.item_id, rec.rating, rec.timestamp)
+        re.add_data_columns(self.partition_columns(partition))
 
-    def _evaluate_scoring_on_partition(self, re: RecommenderEngine, partition: str,
-                                       scorers: List[Callable] = None):
+    @staticmethod
+    def _score_records(re: RecommenderEngine, columns: RatingColumns, scorers: List[Callable],
+                       start: int, end: int, progress: bool = False) -> List[List[float]]:
+        # Predictions are made in chunks through batch API
+        chunks = range(start, end, TimeBasedEvaluator.PREDICTION_CHUNK)
+        if progress:
+            chunks = tqdm.tqdm(chunks)
         scores = []
-        for rec in tqdm.tqdm(self.data_partitions[partition]):
-            prediction = re.predict_rating(rec.user_id, rec.item_id)
-            scores.append([scorer(rec.rating, prediction) for scorer in scorers])
-            if self.allow_rs_updating:
-                re.add_data(rec.user_id, rec.item_id, rec.rating, rec.timestamp)
+        for chunk_start in chunks:
+            chunk_end = min(chunk_start + TimeBasedEvaluator.PREDICTION_CHUNK, end)
+            predictions = re.predict_ratings(columns.user_ids[chunk_start:chunk_end].tolist(),
+                                             columns.item_ids[chunk_start:chunk_end].tolist())
+            scores.extend([[scorer(rating, prediction) for scorer in scorers] for rating, prediction in
+                           zip(columns.ratings[chunk_start:chunk_end].tolist(), predictions.tolist())])
         return scores
+
+    def _evaluate_scoring_parallel(self, re: RecommenderEngine, columns: RatingColumns,
+                                   scorers: List[Callable]) -> List[List[float]]:
+        global _shared_scoring
+        # Workers are forked after build, so they share the model copy-on-write. Shards are contiguous and results
+        # are concatenated in shard order, so scores are the same as in sequential run.
+        bounds = np.linspace(0, len(columns), self.n_jobs + 1).astype(np.int64)
+        _shared_scoring = (re, columns, scorers)
+        try:
+            with multiprocessing.get_context("fork").Pool(self.n_jobs) as pool:
+                shards = pool.map(_score_shard, list(zip(bounds[:-1].tolist(), bounds[1:].tolist())))
+        finally:
+            _shared_scoring = None
+        return [x for shard in shards for x in shard]
+
+    def _evaluate_scoring_on_partition(self, re: RecommenderEngine, partition: str,
+                                       scorers: List[Callable] = None):
+        columns = self.partition_columns(partition)
+        if self.allow_rs_updating:
+            scores = []
+            for user_id, item_id, rating, timestamp in tqdm.tqdm(zip(
+                    columns.user_ids.tolist(), columns.item_ids.tolist(),
+                    columns.ratings.tolist(), columns.timestamps.tolist()), total=len(columns)):
+                prediction = re.predict_rating(user_id, item_id)
+                scores.append([scorer(rating, prediction) for scorer in scorers])
+                re.add_data(user_id, item_id, rating, timestamp)
+            return scores
+        if self.n_jobs > 1 and re.FORK_SAFE and len(columns) >= self.n_jobs:
+            return self._evaluate_scoring_parallel(re, columns, scorers)
+        return self._score_records(re, columns, scorers, 0, len(columns), progress=True)
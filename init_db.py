@@ -4,9 +4,9 @@
 from loader import PostgresLoader
 from loader import MovieLensLoader
 
-source = MovieLensLoader("data/movielens/", 15000000)
+path = "data/movielens/"
 destination = PostgresLoader("postgres", "postgres", "rs_pg", 5432, "mydb", True)
 
-destination.replace_items(source.movies.values())
+destination.replace_items(MovieLensLoader.read_movies(path).values())
 
-destination.replace_ratings(source.get_records())
+destination.bulk_load_ratings(path + "/ratings.csv", 15000000)
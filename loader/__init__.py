@@ -1,3 +1,7 @@
+from .connection_pool import ConnectionPool
+from .item_cache import ItemCache
 from .loader import Loader
 from .movielens_loader import MovieLensLoader
-from .postgres_loader import PostgresLoader
\ No newline at end of file
+from .postgres_loader import PostgresLoader
+from .search_index import ItemSearchIndex
+from .write_behind import WriteBehindBuffer
@@ -0,0 +1,71 @@
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable
+
+
+class ConnectionPool:
+    """
+    Small pool of database connections, opened on demand up to <size>.
+    Connections are not thread-safe, so a thread checks one out for the duration of its work.
+    Prepared statements are cached per connection.
+    """
+    def __init__(self, open_connection: Callable[[], Any], size: int = 4):
+        self._open_connection = open_connection
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        # (id of connection, SQL) -> statement prepared on that connection
+        self._statements = dict()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+        if not can_open:
+            return self._idle.get()
+        try:
+            return self._open_connection()
+        except Exception:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    @contextmanager
+    def connection(self):
+        db = self._acquire()
+        try:
+            yield db
+        finally:
+            self._idle.put(db)
+
+    def prepare(self, db, sql: str):
+        """
+        Returns statement prepared on connection <db> (which must be checked out by the caller)
+        """
+        key = (id(db), sql)
+        statement = self._statements.get(key)
+        if statement is None:
+            statement = db.prepare(sql)
+            self._statements[key] = statement
+        return statement
+
+    def close(self):
+        """
+        Closes idle connections. It should be called when no thread uses the pool anymore.
+        """
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._opened -= 1
+            self._statements = {k: v for k, v in self._statements.items() if k[0] != id(db)}
+            db.close()
@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from common import Item
+
+
+class ItemCache:
+    """
+    Size-bounded LRU cache of item metadata with expiration.
+    Along with the item, it keeps its rendered description, so responses are assembled from ready strings.
+    Unknown ids are cached too (as None), so they do not hit the database on every request.
+    Safe for use from several request threads.
+    """
+    def __init__(self, max_size: int = 100000, ttl: Optional[float] = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, item_ids: Iterable[str]) -> Tuple[Dict[str, Tuple[Optional[Item], str]], List[str]]:
+        """
+        Returns cached (item, description) entries and list of ids that are missing or expired
+        """
+        now = time.monotonic()
+        found = dict()
+        missing = []
+        seen = set()
+        with self._lock:
+            for item_id in item_ids:
+                if item_id in seen:
+                    continue
+                seen.add(item_id)
+                entry = self._entries.get(item_id)
+                if entry is None or (entry[2] is not None and entry[2] < now):
+                    missing.append(item_id)
+                    continue
+                self._entries.move_to_end(item_id)
+                found[item_id] = entry[:2]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put(self, item_id: str, item: Optional[Item], description: str):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[item_id] = (item, description, expires_at)
+            self._entries.move_to_end(item_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, item_ids: Optional[Iterable[str]] = None):
+        """
+        Drops given ids (all entries by default)
+        """
+        with self._lock:
+            if item_ids is None:
+                self._entries.clear()
+            else:
+                for item_id in item_ids:
+                    self._entries.pop(item_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
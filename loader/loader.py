@@ -1,6 +1,8 @@
-from typing import Iterable, Tuple
+from itertools import islice
+from typing import Dict, Iterable, Optional, Tuple
 
-from common import ItemRating, Item
+from common import ItemRating, Item, RatingColumns
+from .search_index import ItemSearchIndex
 
 
 class Loader:
@@ -8,19 +10,71 @@ class Loader:
     It is useful to put data loading/mangling in one separate class.
     This way we can test our RSs on different datasets without changing their logic (in theory at least)
     """
+    def __init__(self):
+        self._search_index = None  # type: Optional[ItemSearchIndex]
 
     def get_records(self) -> Iterable[ItemRating]:
         raise NotImplementedError()
 
+    def get_records_since(self, watermark: Optional[int]) -> Iterable[ItemRating]:
+        """
+        Records with timestamp >= watermark (all records for None watermark), in timestamp order.
+        Default implementation filters get_records(); loaders with indexed storage override it.
+        """
+        records = [x for x in self.get_records() if watermark is None or x.timestamp >= watermark]
+        records.sort(key=lambda x: x.timestamp)
+        return records
+
+    def get_record_columns(self, chunk_size: int = 65536) -> Iterable[RatingColumns]:
+        """
+        Streams records in columnar chunks of up to <chunk_size> records.
+        Default implementation converts get_records(); loaders override it to avoid creating ItemRating objects.
+        """
+        records = iter(self.get_records())
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if len(chunk) == 0:
+                break
+            yield RatingColumns.from_lists([x.user_id for x in chunk], [x.item_id for x in chunk],
+                                           [x.rating for x in chunk], [x.timestamp for x in chunk])
+
     def get_items(self) -> Iterable[Tuple[str, Item]]:
         raise NotImplementedError()
 
     def put_record(self, item_id: str, user_id: str, rating: float, timestamp: int):
         pass
 
+    def close(self):
+        """
+        Finishes pending writes and releases resources
+        """
+        pass
+
     def get_item_genres(self, item_id):
         return []
 
     def get_item_description(self, item_id) -> str:
         raise NotImplementedError()
 
+    def get_items_by_ids(self, item_ids: Iterable[str]) -> Dict[str, Item]:
+        """
+        Bulk lookup of items. Unknown ids are omitted from the result.
+        """
+        raise NotImplementedError()
+
+    def get_item_descriptions(self, item_ids: Iterable[str]) -> Dict[str, str]:
+        """
+        Bulk version of get_item_description; loaders with remote storage override it to fetch items at once
+        """
+        return {x: self.get_item_description(x) for x in item_ids}
+
+    def get_search_index(self) -> ItemSearchIndex:
+        """
+        Returns search index over get_items(). It is built on first call; loaders that change items keep it updated.
+        """
+        index = self._search_index
+        if index is None:
+            index = ItemSearchIndex(self.get_items())
+            self._search_index = index
+        return index
+
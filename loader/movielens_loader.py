@@ -1,29 +1,103 @@
+import logging
+import os
+
+import numpy as np
 import pandas as pd
-from typing import Iterable, List, Dict
+from typing import Iterable, List, Dict, Optional
 from .loader import Loader
-from common import Item, ItemRating
+from common import Item, ItemRating, RatingColumns
+from common.snapshot import SnapshotError, read_snapshot, write_snapshot
 
 
 class MovieLensLoader(Loader):
-    def __init__(self, path: str, clip: int = 100000):
-        self.ratings = pd.read_csv(path + "/ratings.csv", nrows=clip, dtype={
+    """
+    Ratings are kept in columns: int32 codes of users and items (indices into user_ids / item_ids),
+    float32 ratings and int64 timestamps.
+    With cache=True the CSV is parsed only once: columns are saved next to it (or into <cache_dir>) in snapshot
+    format, and later runs memory-map them, so loading takes well under a second regardless of dataset size.
+    Cache is rebuilt when ratings.csv changes.
+    """
+    CACHE_VERSION = 1
+
+    def __init__(self, path: str, clip: int = 100000, cache: bool = False, cache_dir: Optional[str] = None):
+        super().__init__()
+        csv_path = os.path.join(path, "ratings.csv")
+        cache_path = os.path.join(cache_dir if cache_dir is not None else path, "ratings-%d.cache" % clip)
+        source = os.stat(csv_path)
+        meta = {"version": self.CACHE_VERSION, "clip": clip, "size": source.st_size, "mtime": source.st_mtime}
+
+        columns = self._read_cache(cache_path, meta) if cache else None
+        if columns is None:
+            columns = self._read_csv(csv_path, clip)
+            if cache:
+                try:
+                    write_snapshot(cache_path, columns, meta)
+                except OSError:
+                    logging.exception("Cannot write ratings cache %s" % cache_path)
+        self.users = columns["users"]  # type: np.ndarray
+        self.items = columns["items"]  # type: np.ndarray
+        self.ratings = columns["ratings"]  # type: np.ndarray
+        self.timestamps = columns["timestamps"]  # type: np.ndarray
+        self.user_ids = columns["user_ids"]  # type: np.ndarray
+        self.item_ids = columns["item_ids"]  # type: np.ndarray
+
+        self.movies = self.read_movies(path)
+
+    @staticmethod
+    def _read_csv(csv_path: str, clip: int) -> Dict[str, np.ndarray]:
+        ratings = pd.read_csv(csv_path, nrows=clip, dtype={
             "userId": str,
             "movieId": str,
-            "rating": float
+            "rating": np.float32,
+            "timestamp": np.int64
         })
+        users, user_ids = pd.factorize(ratings["userId"])
+        items, item_ids = pd.factorize(ratings["movieId"])
+        return {
+            "users": users.astype(np.int32), "items": items.astype(np.int32),
+            "ratings": ratings["rating"].values.astype(np.float32),
+            "timestamps": ratings["timestamp"].values.astype(np.int64),
+            "user_ids": np.array(user_ids, dtype=str), "item_ids": np.array(item_ids, dtype=str)
+        }
 
+    @staticmethod
+    def _read_cache(cache_path: str, meta: dict) -> Optional[Dict[str, np.ndarray]]:
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            # Cache can always be rebuilt, so checksums are not verified (that would read the whole file)
+            columns, cached_meta = read_snapshot(cache_path, verify=False)
+        except SnapshotError:
+            return None
+        return columns if cached_meta == meta else None
+
+    @staticmethod
+    def read_movies(path: str) -> Dict[str, Item]:
         movies = pd.read_csv(path + "/movies.csv", dtype={
             "movieId": str,
             "title": str,
             "genres": str
         })
-
-        self.movies = {item_id: Item(item_id, name, genres.split("|"))
-                       for item_id, name, genres in movies[["movieId", "title", "genres"]].values}  # type: Dict[str, Item]
+        return {item_id: Item(item_id, name, genres.split("|"))
+                for item_id, name, genres in movies[["movieId", "title", "genres"]].values}
 
     def get_records(self):
-        for user_id, item_id, rating, timestamp in self.ratings[["userId", "movieId", "rating", "timestamp"]].values:
-            yield ItemRating(user_id, item_id, rating, timestamp)
+        for chunk in self.get_record_columns():
+            for user_id, item_id, rating, timestamp in zip(chunk.user_ids.tolist(), chunk.item_ids.tolist(),
+                                                           chunk.ratings.tolist(), chunk.timestamps.tolist()):
+                yield ItemRating(user_id, item_id, rating, timestamp)
+
+    def get_record_columns(self, chunk_size: int = 65536):
+        for start in range(0, len(self.ratings), chunk_size):
+            end = start + chunk_size
+            yield RatingColumns(self.user_ids[self.users[start:end]], self.item_ids[self.items[start:end]],
+                                self.ratings[start:end], self.timestamps[start:end])
+
+    def get_items(self):
+        return self.movies.items()
+
+    def get_items_by_ids(self, item_ids):
+        return {x: self.movies[x] for x in item_ids if x in self.movies}
 
     def get_item_description(self, item_id):
         return str(self.movies.get(item_id, "Unknown"))
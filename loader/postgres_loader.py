@@ -1,49 +1,133 @@
+import time
+from itertools import islice
+
 import pandas as pd
-from typing import Iterable, List, Dict, Tuple
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
+from .connection_pool import ConnectionPool
+from .item_cache import ItemCache
 from .loader import Loader
-from common import Item, ItemRating
+from .write_behind import WriteBehindBuffer
+from common import Item, ItemRating, RatingColumns
 import postgresql
 
 class PostgresLoader(Loader):
-    def __init__(self, ps_login: str, ps_password: str, ps_host: str, ps_port: int, ps_db: str, init_db: bool = False):
+    UPSERT_RATING = "INSERT INTO ratings VALUES ($1, $2, $3, $4) ON CONFLICT (item_id, user_id) " \
+                    "DO UPDATE SET rating = EXCLUDED.rating, timestamp = EXCLUDED.timestamp"
+    # Index for incremental sync (get_records_since)
+    CREATE_TIMESTAMP_INDEX = "CREATE INDEX IF NOT EXISTS ratings_timestamp ON ratings(timestamp)"
+    SELECT_ITEMS = "SELECT item_id, name, genres FROM items WHERE item_id = ANY($1::varchar[])"
+    # Limits of ratings table columns (see _init_db) and of MovieLens rating scale
+    MAX_ID_LENGTH = 16
+    MIN_RATING = 0.5
+    MAX_RATING = 5.0
+
+    def __init__(self, ps_login: str, ps_password: str, ps_host: str, ps_port: int, ps_db: str, init_db: bool = False,
+                 cache_size: int = 100000, cache_ttl: Optional[float] = 3600.0, fetch_chunk_size: int = 65536,
+                 pool_size: int = 4, write_batch: int = 1000, write_interval: float = 1.0):
+        super().__init__()
         if init_db:
             with postgresql.open('pq://%s:%s@%s:%s/' % (ps_login, ps_password, ps_host, ps_port)) as db:
                 if len(db.query("SELECT * FROM pg_catalog.pg_database WHERE datname=$1", ps_db)) == 0:
                     db.execute("CREATE DATABASE %s" % (ps_db))
-        self.connection = postgresql.open('pq://%s:%s@%s:%s/%s' % (ps_login, ps_password, ps_host, ps_port, ps_db))
+        url = 'pq://%s:%s@%s:%s/%s' % (ps_login, ps_password, ps_host, ps_port, ps_db)
+        # Main connection is used for bulk operations (initialization, loading); concurrent work from request
+        # and background threads goes through the pool
+        self.connection = postgresql.open(url)
+        self.pool = ConnectionPool(lambda: postgresql.open(url), pool_size)
         if init_db:
             self._init_db()
-        self._item_map = None  # type: Dict[str, Item]
-        self._insert_items = self.connection.prepare("INSERT INTO ratings VALUES ($1, $2, $3, $4) ON "
-                                                     "CONFLICT (item_id, user_id) "
-                                                     "DO UPDATE SET rating = EXCLUDED.rating, timestamp = EXCLUDED.timestamp")
-
-    def get_records(self):
-        for item_id, user_id, rating, timestamp in \
-                self.connection.query("SELECT item_id, user_id, rating, timestamp FROM ratings"):
-            yield ItemRating(user_id, item_id, rating, timestamp)
-
-    def _ensure_items(self):
-        if self._item_map is None:
-            self._item_map = {}
-            for item_id, name, genres in \
-                    self.connection.query("SELECT item_id, name, genres FROM items"):
-                self._item_map[item_id] = Item(item_id, name, genres.split(","))
+        else:
+            # Databases created before the timestamp index was introduced get it here
+            self.connection.execute(self.CREATE_TIMESTAMP_INDEX)
+        self.fetch_chunk_size = fetch_chunk_size
+        self._item_cache = ItemCache(cache_size, cache_ttl)
+        self._insert_items = self.connection.prepare(self.UPSERT_RATING)
+        # put_record() only queues the rating; it is written in batches by this thread, started by the first rating
+        self._rating_writes = WriteBehindBuffer(self._write_ratings, key=lambda x: (x[0], x[1]),
+                                                max_batch=write_batch, flush_interval=write_interval)
 
-    def get_item_description(self, item_id):
-        self._ensure_items()
+    def _fetch_chunks(self, chunk_size: int, db=None, where: str = "", parameters: tuple = ()) -> Iterator[list]:
+        # Server-side cursor: only one chunk of rows is held client-side at a time.
+        # Cursor lives within the transaction, which is kept open until the generator is exhausted or closed, so it
+        # runs on a pooled connection (<db> is one checked out by the caller), never on the shared main one.
+        # Closing the generator (which also happens when the consumer drops it) rolls the transaction back
+        # and returns the connection.
+        if db is None:
+            with self.pool.connection() as db:
+                yield from self._fetch_chunks(chunk_size, db, where, parameters)
+            return
+        select = self.pool.prepare(db, "SELECT item_id, user_id, rating, timestamp FROM ratings " + where)
+        with db.xact():
+            cursor = select.declare(*parameters)
+            while True:
+                rows = cursor.read(chunk_size)
+                if len(rows) == 0:
+                    break
+                yield rows
+
+    def get_records(self, chunk_size: Optional[int] = None):
+        for rows in self._fetch_chunks(chunk_size or self.fetch_chunk_size):
+            for item_id, user_id, rating, timestamp in rows:
+                yield ItemRating(user_id, item_id, rating, timestamp)
 
-        if item_id in self._item_map:
-            return str(self._item_map.get(item_id, "Unknown"))
+    def get_records_since(self, watermark: Optional[int], chunk_size: Optional[int] = None) -> Iterator[ItemRating]:
+        """
+        Streams ratings with timestamp >= watermark in timestamp order, using ratings_timestamp index.
+        Bound is inclusive, so ratings that share the watermark timestamp are not missed; consumers should skip
+        ratings they already have (see RecommenderEngine.apply_deltas). Runs on pooled connection, also without
+        watermark (then all ratings are streamed, in storage order), since it is called from background threads.
+        """
+        if watermark is None:
+            where, parameters = "", ()
         else:
-            return "Unknown"
+            where, parameters = "WHERE timestamp >= $1 ORDER BY timestamp", (watermark,)
+        with self.pool.connection() as db:
+            for rows in self._fetch_chunks(chunk_size or self.fetch_chunk_size, db, where, parameters):
+                for item_id, user_id, rating, timestamp in rows:
+                    yield ItemRating(user_id, item_id, rating, timestamp)
+
+    def get_record_columns(self, chunk_size: Optional[int] = None) -> Iterator[RatingColumns]:
+        for rows in self._fetch_chunks(chunk_size or self.fetch_chunk_size):
+            item_ids, user_ids, ratings, timestamps = zip(*rows)
+            yield RatingColumns.from_lists(user_ids, item_ids, ratings, timestamps)
+
+    @staticmethod
+    def _make_item(item_id: str, name: str, genres: str) -> Item:
+        return Item(item_id, name, genres.split(",") if genres else [])
+
+    def get_items_by_ids(self, item_ids: Iterable[str]) -> Dict[str, Item]:
+        return {k: item for k, (item, _) in self._lookup_items(item_ids).items() if item is not None}
+
+    def get_item_descriptions(self, item_ids: Iterable[str]) -> Dict[str, str]:
+        return {k: description for k, (_, description) in self._lookup_items(item_ids).items()}
+
+    def _lookup_items(self, item_ids: Iterable[str]) -> Dict[str, Tuple[Optional[Item], str]]:
+        # Cache misses are fetched with one query
+        found, missing = self._item_cache.get_many(item_ids)
+        if len(missing) > 0:
+            with self.pool.connection() as db:
+                rows = self.pool.prepare(db, self.SELECT_ITEMS)(missing)
+            fetched = {item_id: self._make_item(item_id, name, genres) for item_id, name, genres in rows}
+            for item_id in missing:
+                item = fetched.get(item_id)
+                entry = (item, str(item) if item is not None else "Unknown")
+                self._item_cache.put(item_id, *entry)
+                found[item_id] = entry
+        return found
+
+    def get_item_description(self, item_id):
+        return self.get_item_descriptions([item_id])[item_id]
 
     def replace_items(self, items: Iterable[Item]):
-        insert_items = self.connection.prepare("INSERT INTO items VALUES ($1, $2, $3) ON CONFLICT DO NOTHING")
+        insert_items = self.connection.prepare("INSERT INTO items VALUES ($1, $2, $3) ON CONFLICT (item_id) "
+                                               "DO UPDATE SET name = EXCLUDED.name, genres = EXCLUDED.genres")
         buffer = []
         for m in items:
             buffer.append((str(m.item_id), str(m.name)[:128], ",".join(m.genres)[:128]))
         insert_items.load_rows(buffer)
+        self._item_cache.invalidate([x[0] for x in buffer])
+        if self._search_index is not None:
+            self._search_index.add_items([(x[0], self._make_item(*x)) for x in buffer])
 
     def replace_ratings(self, ratings: Iterable[ItemRating], batch_size = 10000):
         buffer = []
@@ -55,17 +139,99 @@ class PostgresLoader(Loader):
         if len(buffer) > 0:
             self._insert_items.load_rows(buffer)
 
+    @staticmethod
+    def _csv_chunks(path: str, limit: Optional[int], chunk_size: int) -> Iterator[List[bytes]]:
+        with open(path, "rb") as f:
+            f.readline()  # header
+            rows = 0
+            while limit is None or rows < limit:
+                size = chunk_size if limit is None else min(chunk_size, limit - rows)
+                chunk = list(islice(f, size))
+                if len(chunk) == 0:
+                    break
+                rows += len(chunk)
+                yield chunk
+
+    def bulk_load_ratings(self, path: str, limit: Optional[int] = None, chunk_size: int = 65536) -> int:
+        """
+        Loads ratings from CSV file with columns user_id,item_id,rating,timestamp and a header line
+        (MovieLens ratings.csv format). The file is streamed in chunks of lines into COPY FROM STDIN of staging
+        table without indexes, and then merged into ratings with one statement (of duplicates, the latest rating wins),
+        so memory use does not depend on file size. If ratings table is empty, its primary key is built after the merge.
+        Returns number of loaded lines.
+        """
+        started = time.time()
+        with self.connection.xact():
+            self.connection.execute("CREATE TEMP TABLE ratings_staging(user_id varchar(16), item_id varchar(16), "
+                                    "rating float, timestamp int) ON COMMIT DROP")
+            copy = self.connection.prepare("COPY ratings_staging FROM STDIN WITH (FORMAT csv)")
+            copy.load_chunks(self._csv_chunks(path, limit, chunk_size))
+            rows = self.connection.prepare("SELECT count(*) FROM ratings_staging").first()
+            copied = time.time()
+            print("Copied %d rows in %.1f s (%.0f rows/s)" %
+                  (rows, copied - started, rows / max(copied - started, 1e-9)))
+
+            merge = "INSERT INTO ratings (item_id, user_id, rating, timestamp) " \
+                    "SELECT DISTINCT ON (item_id, user_id) item_id, user_id, rating, timestamp FROM ratings_staging " \
+                    "ORDER BY item_id, user_id, timestamp DESC"
+            empty = self.connection.prepare("SELECT NOT EXISTS (SELECT 1 FROM ratings)").first()
+            if empty:
+                self.connection.execute("ALTER TABLE ratings DROP CONSTRAINT IF EXISTS ratings_pkey")
+                self.connection.execute("DROP INDEX IF EXISTS ratings_timestamp")
+                self.connection.execute(merge)
+                self.connection.execute("ALTER TABLE ratings ADD PRIMARY KEY (item_id, user_id)")
+                self.connection.execute(self.CREATE_TIMESTAMP_INDEX)
+            else:
+                self.connection.execute(merge + " ON CONFLICT (item_id, user_id) "
+                                        "DO UPDATE SET rating = EXCLUDED.rating, timestamp = EXCLUDED.timestamp")
+        self.connection.execute("ANALYZE ratings")
+        finished = time.time()
+        print("Merged in %.1f s, %.0f rows/s overall" % (finished - copied, rows / max(finished - started, 1e-9)))
+        return rows
+
     def get_items(self) -> Iterable[Tuple[str, Item]]:
-        self._ensure_items()
-        for k, i in self._item_map.items():
-            yield k, i
+        with self.pool.connection() as db:
+            rows = db.query("SELECT item_id, name, genres FROM items")
+        for item_id, name, genres in rows:
+            yield item_id, self._make_item(item_id, name, genres)
+
+    @classmethod
+    def validate_record(cls, item_id: str, user_id: str, rating: float):
+        """
+        Raises ValueError if the rating cannot be stored in ratings table. Writes are asynchronous, so callers
+        check records with it before queuing them.
+        """
+        for name, value in (("item_id", item_id), ("user_id", user_id)):
+            if not isinstance(value, str) or not 0 < len(value) <= cls.MAX_ID_LENGTH:
+                raise ValueError("%s must be a string of 1 to %d characters" % (name, cls.MAX_ID_LENGTH))
+        # Also rejects NaN
+        if not cls.MIN_RATING <= rating <= cls.MAX_RATING:
+            raise ValueError("rating must be between %s and %s" % (cls.MIN_RATING, cls.MAX_RATING))
 
     def put_record(self, item_id: str, user_id: str, rating: float, timestamp: int):
-        print("Inserting the record")
-        self._insert_items(item_id, user_id, rating, timestamp)
+        """
+        Queues the rating for writing; it reaches the database within write_interval seconds.
+        Raises ValueError for ratings that cannot be stored (see validate_record).
+        """
+        self.validate_record(item_id, user_id, rating)
+        self._rating_writes.put((item_id, user_id, rating, timestamp))
+
+    def _write_ratings(self, rows: List[Tuple[str, str, float, int]]):
+        with self.pool.connection() as db:
+            with db.xact():
+                self.pool.prepare(db, self.UPSERT_RATING).load_rows(rows)
+
+    def close(self):
+        """
+        Writes queued ratings and closes connections
+        """
+        self._rating_writes.close()
+        self.pool.close()
+        self.connection.close()
 
     def get_item_genres(self, item_id: str):
-        return []
+        item = self.get_items_by_ids([item_id]).get(item_id)
+        return item.genres if item is not None else []
 
     def _init_db(self):
         self.connection.query("DROP TABLE IF EXISTS items")
@@ -73,3 +239,4 @@ class PostgresLoader(Loader):
         self.connection.query("CREATE TABLE items(item_id varchar(16) PRIMARY KEY, name varchar(256), genres varchar(256))")
         self.connection.query("CREATE TABLE ratings(item_id varchar(16), user_id varchar(16), "
                               "rating float, timestamp int, PRIMARY KEY(item_id, user_id))")
+        self.connection.execute(self.CREATE_TIMESTAMP_INDEX)
@@ -0,0 +1,140 @@
+import heapq
+import re
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Iterable, List, Optional, Set, Tuple
+
+from common import Item
+
+
+class ItemSearchIndex:
+    """
+    Inverted index from tokens of item titles and genres to item ids, for search as you type.
+    All query tokens must match (posting lists are intersected, smallest first); the last token also matches
+    as a prefix, so "star wa" finds "Star Wars". Matches are ranked by popularity (ties by id), which is evaluated
+    only for the matches.
+
+    Short last token (up to SHORT_PREFIX_LENGTH characters, e.g. the first keystroke) would be expanded to a large
+    part of the vocabulary, so instead it is checked against tokens of candidates. If there are no other tokens
+    (also for empty query), candidates are all items: they are walked in popularity order until n of them match.
+    This order is kept in a list that is rebuilt lazily, when items or popularity function change, or after
+    RANKING_TTL seconds, so it may lag behind popularity by that much.
+    """
+    _TOKEN = re.compile(r"\w+")
+    SHORT_PREFIX_LENGTH = 2
+    RANKING_TTL = 60.0
+
+    def __init__(self, items: Iterable[Tuple[str, Item]] = ()):
+        # Item id -> item, and -> its tokens
+        self.items = dict()
+        self.tokens = dict()
+        # Token -> set of ids of items that have it
+        self.postings = dict()
+        # Sorted tokens for prefix lookups; rebuilt lazily after vocabulary changes
+        self._vocabulary = None  # type: Optional[List[str]]
+        # (popularity function, build time, ids of all items ordered by popularity); rebuilt lazily
+        self._ranking = None  # type: Optional[Tuple[Optional[Callable[[str], float]], float, List[str]]]
+        self.add_items(items)
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        return cls._TOKEN.findall(text.lower())
+
+    def _item_tokens(self, item: Item) -> Set[str]:
+        tokens = set(self.tokenize(item.name))
+        for genre in item.genres:
+            tokens.update(self.tokenize(genre))
+        return tokens
+
+    def add_item(self, item_id: str, item: Item):
+        """
+        Adds the item, or re-indexes it if it is already there
+        """
+        self.remove_item(item_id)
+        self.items[item_id] = item
+        tokens = self._item_tokens(item)
+        self.tokens[item_id] = tokens
+        self._ranking = None
+        for token in tokens:
+            if token not in self.postings:
+                self.postings[token] = set()
+                self._vocabulary = None
+            self.postings[token].add(item_id)
+
+    def add_items(self, items: Iterable[Tuple[str, Item]]):
+        for item_id, item in items:
+            self.add_item(item_id, item)
+
+    def remove_item(self, item_id: str):
+        if self.items.pop(item_id, None) is None:
+            return
+        self._ranking = None
+        for token in self.tokens.pop(item_id):
+            posting = self.postings[token]
+            posting.discard(item_id)
+            if len(posting) == 0:
+                del self.postings[token]
+                self._vocabulary = None
+
+    def _prefix_matches(self, prefix: str) -> Set[str]:
+        vocabulary = self._vocabulary
+        if vocabulary is None:
+            vocabulary = sorted(self.postings.keys())
+            self._vocabulary = vocabulary
+        matches = set()
+        for pos in range(bisect_left(vocabulary, prefix), len(vocabulary)):
+            if not vocabulary[pos].startswith(prefix):
+                break
+            matches.update(self.postings.get(vocabulary[pos], ()))
+        return matches
+
+    @staticmethod
+    def _rank_key(popularity: Optional[Callable[[str], float]]) -> Callable[[str], Any]:
+        if popularity is None:
+            return lambda x: x
+        return lambda x: (-popularity(x), x)
+
+    def _ranked_items(self, popularity: Optional[Callable[[str], float]]) -> List[str]:
+        ranking = self._ranking
+        if ranking is None or ranking[0] != popularity or time.time() - ranking[1] > self.RANKING_TTL:
+            ranking = (popularity, time.time(), sorted(self.items.keys(), key=self._rank_key(popularity)))
+            self._ranking = ranking
+        return ranking[2]
+
+    def search(self, query: str, n: int = 30, popularity: Optional[Callable[[str], float]] = None,
+               prefix: bool = True) -> List[Tuple[str, Item]]:
+        """
+        Returns up to n (item_id, item) pairs matching all tokens of the query, most popular first.
+        <popularity> maps item id to a score (e.g. number of ratings); without it, matches are ordered by id.
+        Empty query matches every item, so it returns the most popular items.
+        """
+        tokens = self.tokenize(query)
+        short_prefix = None  # type: Optional[str]
+        if len(tokens) == 0 or (prefix and len(tokens[-1]) <= self.SHORT_PREFIX_LENGTH):
+            # Its posting lists would cover a large part of the catalog, so it is checked against tokens of candidates
+            short_prefix = tokens.pop() if len(tokens) > 0 else ""
+        postings = [self.postings.get(x, set()) for x in tokens]
+        if short_prefix is None and prefix:
+            postings[-1] = self._prefix_matches(tokens[-1])
+
+        def matches(item_id: str) -> bool:
+            return not short_prefix or any(x.startswith(short_prefix) for x in self.tokens[item_id])
+
+        if len(postings) == 0:
+            # Walking all items in popularity order, until n of them match
+            best = []
+            for item_id in self._ranked_items(popularity):
+                if len(best) >= n:
+                    break
+                if matches(item_id):
+                    best.append(item_id)
+            return [(x, self.items[x]) for x in best]
+
+        postings.sort(key=len)
+        found = set(postings[0])
+        for posting in postings[1:]:
+            if len(found) == 0:
+                break
+            found &= posting
+        best = heapq.nsmallest(n, filter(matches, found), key=self._rank_key(popularity))
+        return [(x, self.items[x]) for x in best]
@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List
+
+
+class WriteBehindBuffer(threading.Thread):
+    """
+    Collects rows and writes them in batches on this background thread, so callers never wait for the database.
+    A batch is flushed once <max_batch> rows are pending, or <flush_interval> seconds after the first pending row.
+    Rows with equal key (e.g. repeated rating of the same item by the same user) are coalesced, the latest wins.
+
+    If a batch fails, its rows are written one by one, so a single bad row does not block the others: rows that fail
+    while others succeed are rejected (logged and counted). If all of them fail, the database is likely unavailable,
+    so rows are kept and retried on the next flush; when more than <max_pending> rows are pending, the oldest ones are
+    dropped (and reported), so a long database outage does not exhaust memory.
+
+    The thread is started by the first put(), so a process that only creates the buffer (e.g. before forking
+    workers) runs no threads. close() flushes everything that is pending before returning.
+    """
+    def __init__(self, write: Callable[[List[Any]], None], key: Callable[[Any], Hashable],
+                 max_batch: int = 1000, flush_interval: float = 1.0, max_pending: int = 1000000):
+        super().__init__(daemon=True)
+        self.write = write
+        self.key = key
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = OrderedDict()  # type: OrderedDict
+        self._oldest = None  # type: float
+        self._condition = threading.Condition()
+        self._closing = False
+        self._thread_started = False
+
+        # Metrics
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def put(self, row: Any):
+        with self._condition:
+            if self._closing:
+                raise RuntimeError("Write-behind buffer is closed")
+            if not self._thread_started:
+                self._thread_started = True
+                self.start()
+            key = self.key(row)
+            self._pending.pop(key, None)
+            self._pending[key] = row
+            if len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+            # Waking the thread to start flush timer for the first row, or to flush full batch
+            if self._oldest is None:
+                self._oldest = time.time()
+                self._condition.notify()
+            elif len(self._pending) >= self.max_batch:
+                self._condition.notify()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _take_batch(self) -> List[Any]:
+        # Must be called with condition held
+        batch = []
+        while len(self._pending) > 0 and len(batch) < self.max_batch:
+            batch.append(self._pending.popitem(last=False)[1])
+        self._oldest = time.time() if len(self._pending) > 0 else None
+        return batch
+
+    def _write_rows(self, batch: List[Any]) -> List[Any]:
+        """
+        Writes rows of failed batch one by one. Returns rows that failed.
+        """
+        failed = []
+        for row in batch:
+            try:
+                self.write([row])
+                self.written += 1
+            except Exception:
+                failed.append(row)
+        return failed
+
+    def _flush(self, batch: List[Any]) -> bool:
+        try:
+            self.write(batch)
+            self.written += len(batch)
+            self.flushes += 1
+            return True
+        except Exception:
+            self.failures += 1
+            logging.exception("Exception during writing %d rows, writing them one by one" % len(batch))
+        failed = self._write_rows(batch)
+        if len(failed) < len(batch):
+            # Database accepts other rows, so the failed ones are bad
+            for row in failed:
+                logging.error("Rejected row %r" % (row,))
+            self.rejected += len(failed)
+            self.flushes += 1
+            return True
+        logging.error("None of %d rows is written, will retry" % len(batch))
+        with self._condition:
+            # Returning rows to the head of the queue, unless they were overwritten meanwhile
+            retained = OrderedDict((self.key(row), row) for row in batch)
+            for key, row in self._pending.items():
+                retained.pop(key, None)
+                retained[key] = row
+            self._pending = retained
+            self._oldest = time.time()
+        return False
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._closing:
+                    if len(self._pending) >= self.max_batch:
+                        break
+                    if self._oldest is not None:
+                        wait = self._oldest + self.flush_interval - time.time()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self._condition.wait(wait)
+                if self._closing and len(self._pending) == 0:
+                    return
+                batch = self._take_batch()
+                closing = self._closing
+            if self._flush(batch):
+                continue
+            with self._condition:
+                if closing:
+                    logging.error("Dropping %d unwritten rows on close" % len(self._pending))
+                    self.dropped += len(self._pending)
+                    return
+                # Backing off before retry
+                self._condition.wait(self.flush_interval)
+
+    def close(self):
+        """
+        Flushes pending rows and stops the thread
+        """
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
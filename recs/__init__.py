@@ -1,6 +1,12 @@
+from .interaction_store import InteractionStore
 from .recommender_engine import RecommenderEngine
 from .heuristic import HeuristicRE
 from .svd_based_recs import SVDBasedCF
 from .average_rating_recs import AverageRatingRecs
-from .ann_recs import ANNRecs
+from .ann_inference import ANNInference
 from .user_cf import UserBasedNNCF
+from .item_based_recs import ItemCF
+
+# ANNRecs is not imported here, since it imports Keras: training code imports it from recs.ann_recs
+__all__ = ["InteractionStore", "RecommenderEngine", "HeuristicRE", "SVDBasedCF", "AverageRatingRecs", "ANNInference",
+           "UserBasedNNCF", "ItemCF"]
@@ -0,0 +1,107 @@
+from typing import List
+
+import numpy as np
+
+from .ranking import top_n_indices
+from .recommender_engine import RecommenderEngine
+
+
+class ANNInference(RecommenderEngine):
+    """
+    Trained ANNRecs model as plain NumPy arrays (see ANNRecs.export()): embeddings, and kernels and biases of dense
+    layers (ReLU on hidden ones, linear output). It does not import Keras, so it starts fast and can be saved to and
+    served from snapshots by a lean process. It cannot be trained: build() keeps the exported weights, so generic
+    code that builds engines (evaluator, rebuilds in server) works with it, but new users and items are only
+    learned by exporting a retrained ANNRecs.
+
+    The first dense layer is applied to concatenation of user and item embeddings, so its kernel splits into user
+    and item parts: [u, i] W = u W_u + i W_i. Both products are precomputed for all users and items, and scoring
+    starts from sum of two rows. Top-N for a user scores all items with a few matrix products.
+    """
+    # Pairs scored at once in predict_ratings
+    PREDICT_BATCH_SIZE = 4096
+
+    def __init__(self):
+        super().__init__()
+        # Embedding rows are user and item indices of interaction store
+        self.user_embeddings = None  # type: np.ndarray
+        self.item_embeddings = None  # type: np.ndarray
+        self.kernels = []  # type: List[np.ndarray]
+        self.biases = []  # type: List[np.ndarray]
+        # Products of embeddings with parts of the first kernel (bias of the first layer is added to user part)
+        self.user_projections = None  # type: np.ndarray
+        self.item_projections = None  # type: np.ndarray
+        self.item_ids = np.zeros(0, dtype=object)  # type: np.ndarray
+
+    def set_weights(self, user_embeddings: np.ndarray, item_embeddings: np.ndarray, layers: List[List[np.ndarray]]):
+        """
+        <layers> are [kernel, bias] of dense layers, the last one being the output
+        """
+        self.user_embeddings = np.asarray(user_embeddings, dtype=np.float32)
+        self.item_embeddings = np.asarray(item_embeddings, dtype=np.float32)
+        self.kernels = [np.asarray(x[0], dtype=np.float32) for x in layers]
+        self.biases = [np.asarray(x[1], dtype=np.float32) for x in layers]
+        user_size = self.user_embeddings.shape[1]
+        self.user_projections = self.user_embeddings.dot(self.kernels[0][:user_size]) + self.biases[0]
+        self.item_projections = self.item_embeddings.dot(self.kernels[0][user_size:])
+        self.item_ids = np.array(self.interactions.item_ids[:len(self.item_embeddings)], dtype=object)
+
+    def build(self):
+        # Weights are set by ANNRecs.export() or load()
+        pass
+
+    def _get_model_state(self):
+        if self.user_embeddings is None:
+            return {}, {}
+        arrays = {"user_embeddings": self.user_embeddings, "item_embeddings": self.item_embeddings}
+        for i, (kernel, bias) in enumerate(zip(self.kernels, self.biases)):
+            arrays["kernel_%d" % i] = kernel
+            arrays["bias_%d" % i] = bias
+        return arrays, {"layers": len(self.kernels)}
+
+    def _set_model_state(self, arrays, params):
+        if "user_embeddings" not in arrays:
+            return
+        self.set_weights(arrays["user_embeddings"], arrays["item_embeddings"],
+                         [[arrays["kernel_%d" % i], arrays["bias_%d" % i]] for i in range(params["layers"])])
+
+    def _forward(self, hidden: np.ndarray) -> np.ndarray:
+        """
+        Returns outputs given pre-activations of the first dense layer
+        """
+        for kernel, bias in zip(self.kernels[1:], self.biases[1:]):
+            hidden = np.maximum(hidden, 0.0).dot(kernel) + bias
+        return hidden[:, 0]
+
+    def _user_row(self, user_id: str) -> int:
+        row = self.interactions.user_index.get(user_id, -1)
+        if row < 0 or row >= len(self.user_embeddings):
+            raise Exception("Unknown user %s" % user_id)
+        return row
+
+    def predict_rating(self, user_id: str, item_id: str) -> float:
+        return float(self.predict_ratings([user_id], [item_id])[0])
+
+    def predict_ratings(self, user_ids: List[str], item_ids: List[str]) -> np.ndarray:
+        users = np.array([self._user_row(x) for x in user_ids], dtype=np.int64)
+        items = np.array([self.interactions.item_index.get(x, -1) for x in item_ids], dtype=np.int64)
+        items[items >= len(self.item_embeddings)] = -1
+        ratings = np.zeros(len(users))
+        known = np.flatnonzero(items >= 0)
+        for start in range(0, len(known), self.PREDICT_BATCH_SIZE):
+            batch = known[start:start + self.PREDICT_BATCH_SIZE]
+            ratings[batch] = self._forward(self.user_projections[users[batch]] + self.item_projections[items[batch]])
+        store = self.interactions
+        for i in np.flatnonzero(items < 0):
+            # Same fallback as in ANNRecs: mean rating of the user
+            ratings[i] = np.mean(store.ratings[store.user_records(users[i])])
+        return ratings
+
+    def predict_interests(self, user_id: str, n: int = 5) -> List[str]:
+        user_index = self.interactions.user_index.get(user_id)
+        if user_index is None or user_index >= len(self.user_embeddings):
+            return []
+        scores = self._forward(self.user_projections[user_index] + self.item_projections)
+        seen = self.interactions.items[self.interactions.user_records(user_index)]
+        scores[seen[seen < len(scores)]] = -np.inf
+        return self.item_ids[top_n_indices(scores, n)].tolist()
@@ -1,11 +1,37 @@
-from typing import List, Tuple, Dict, Iterable, Set
+from typing import List, Tuple, Dict
 import numpy as np
 
-from common import ItemRating
+from .ann_inference import ANNInference
 from .recommender_engine import RecommenderEngine
 from keras.models import Sequential, Model
 from keras.layers import Dense, Activation, Input, Dot, Embedding, Flatten, Add, Concatenate
 from keras.regularizers import l2
+from keras.utils import Sequence
+
+
+class RatingBatches(Sequence):
+    """
+    Batches of pre-encoded (user, item, rating) arrays. Every epoch goes through all records once: records are
+    shuffled and then sliced into batches, so preparing a batch is a single fancy indexing operation.
+    Being a Sequence, it can be prepared by several workers in parallel with training.
+    """
+    def __init__(self, users: np.ndarray, items: np.ndarray, ratings: np.ndarray, batch_size: int):
+        self.users = users
+        self.items = items
+        self.ratings = ratings
+        self.batch_size = batch_size
+        self.order = np.random.permutation(len(ratings))
+
+    def __len__(self) -> int:
+        return int(np.ceil(len(self.ratings) / self.batch_size))
+
+    def __getitem__(self, index: int) -> Tuple[List[np.ndarray], np.ndarray]:
+        batch = self.order[index * self.batch_size:(index + 1) * self.batch_size]
+        return [self.users[batch], self.items[batch]], self.ratings[batch]
+
+    def on_epoch_end(self):
+        self.order = np.random.permutation(len(self.ratings))
+
 
 class ANNRecs(RecommenderEngine):
     """
@@ -15,11 +41,16 @@ class ANNRecs(RecommenderEngine):
     regression task and minimizes MSE while the one in the paper is used as a classifier and minimizes logloss.
     This change is required because currently we assume that our goal is rating prediction.
     """
+    # TensorFlow session state does not survive fork
+    FORK_SAFE = False
+    # Pairs scored by single model.predict() call in predict_ratings
+    PREDICT_BATCH_SIZE = 4096
+
     def __init__(self, batch_size: int = 64,
                  user_embedding_size: int = 64, item_embedding_size: int = 64,
                  dense_sizes: List[int] = None,
                  epochs: int = 100, lr: float = .01, decay: float=1e-6,
-                 validation_size: float = 0.1):
+                 validation_size: float = 0.1, workers: int = 2):
         if dense_sizes is None:
             dense_sizes = [32, 16, 8]
         self.batch_size = batch_size
@@ -30,96 +61,92 @@ class ANNRecs(RecommenderEngine):
         self.decay = decay
         self.lr = lr
 
+        # Number of threads preparing batches
+        self.workers = workers
+
         self.model = None  # type: Model
+        # Embedding rows are user and item indices of interaction store
         self.user_indices = {}  # type: Dict[str, int]
-        self.user_indices_reverse = {}  # type: Dict[int, str]
         self.item_indices = {}  # type: Dict[str, int]
-        self.item_indices_reverse = {}  # type: Dict[str, int]
-        self.user_train_items = {} # type: Dict[str, List[ItemRating]]
-        self.user_validation_items = {} # type: Dict[str, List[ItemRating]]
         self.validation_size = validation_size
-        # Users with validation interactions
-        self.validation_users = set() # type: List[str]
 
         super().__init__()
 
-    def _train_batch_generator(self) -> Iterable[Tuple[List, Iterable]]:
-        items = np.zeros(self.batch_size)
-        ratings = np.zeros(self.batch_size)
-        while True:
-            users = np.random.randint(0, len(self.user_indices), self.batch_size)
-            for i, user_id_index in enumerate(users):
-                history = self.user_train_items[self.user_indices_reverse[user_id_index]]
-                random_entry = history[np.random.choice(len(history))]
-                items[i] = self.item_indices[random_entry.item_id]
-                ratings[i] = random_entry.rating
-            yield [users, items], ratings
-
-    def _validation_batch_generator(self) -> Iterable[Tuple[List, Iterable]]:
-        items = np.zeros(self.batch_size)
-        ratings = np.zeros(self.batch_size)
-        while True:
-            users = np.random.randint(0, len(self.validation_users), self.batch_size)
-            for i, user_id in enumerate(users):
-                history = self.user_validation_items[self.validation_users[user_id]]
-                random_entry = history[np.random.choice(len(history))]
-                items[i] = self.item_indices[random_entry.item_id]
-                ratings[i] = random_entry.rating
-            yield [users, items], ratings
+    def _split_validation(self, users: np.ndarray) -> np.ndarray:
+        """
+        Returns mask of records held out for validation: floor(validation_size * history size) random records
+        of each user
+        """
+        if self.validation_size is None or self.validation_size == 0.0:
+            return np.zeros(len(users), dtype=bool)
+        order = np.lexsort((np.random.rand(len(users)), users))
+        history_sizes = np.bincount(users, minlength=self.interactions.n_users)
+        starts = np.cumsum(history_sizes) - history_sizes
+        # Position of record within (shuffled) history of its user
+        ranks = np.arange(len(users)) - starts[users[order]]
+        validation = np.zeros(len(users), dtype=bool)
+        validation[order] = ranks < np.floor(history_sizes * self.validation_size)[users[order]]
+        return validation
 
     def _get_model(self) -> Model:
         input_user = Input(shape=(1,))
         input_item = Input(shape=(1,))
 
-        user_emb = Embedding(len(self.user_histories), self.user_embedding_size, input_length=1, embeddings_regularizer=l2(1e-6))
-        item_emb = Embedding(len(self.item_histories), self.item_embedding_size, input_length=1, embeddings_regularizer=l2(1e-6))
+        user_emb = Embedding(self.interactions.n_users, self.user_embedding_size, input_length=1, embeddings_regularizer=l2(1e-6),
+                             name="user_embedding")
+        item_emb = Embedding(self.interactions.n_items, self.item_embedding_size, input_length=1, embeddings_regularizer=l2(1e-6),
+                             name="item_embedding")
 
         current_layer = Concatenate()([
             Flatten()(user_emb(input_user)),
             Flatten()(item_emb(input_item))
         ])
-        for i in self.dense_sizes:
-            current_layer = Dense(i, activation="relu")(current_layer)
-        output = Dense(1)(current_layer)
+        for i, size in enumerate(self.dense_sizes):
+            current_layer = Dense(size, activation="relu", name="dense_%d" % i)(current_layer)
+        output = Dense(1, name="output")(current_layer)
         model = Model(inputs=[input_user, input_item], outputs=output)
 
         return model
 
     def build(self):
-        history_size = 0
-        self.validation_users = []
-        self.user_indices = {}
-        for i, j in enumerate(self.user_histories):
-            self.user_indices[j] = i
-            self.user_indices_reverse[i] = j
-            self.user_validation_items[j] = np.random.choice(
-                    self.user_histories[j],
-                    int(np.floor(len(self.user_histories[j]) * self.validation_size))
-                )
-            if len(self.user_validation_items[j]) > 0:
-                self.validation_users.append(j)
-            self.user_train_items[j] = list(set(self.user_histories[j]) - set(self.user_validation_items[j]))
-            history_size += len(self.user_histories[j])
-        self.item_indices = {}
-        for i, j in enumerate(self.item_histories):
-            self.item_indices[j] = i
-            self.item_indices_reverse[i] = j
+        store = self.interactions
+        self.user_indices = dict(store.user_index)
+        self.item_indices = dict(store.item_index)
+        users = store.users.astype(np.int32)
+        items = store.items.astype(np.int32)
+        ratings = store.ratings.astype(np.float32)
+        validation = self._split_validation(users)
+        train = ~validation
+
         self.model = self._get_model()
         self.model.compile(optimizer="adam", loss="mse")
 
         self.model.optimizer.lr = self.lr
         self.model.optimizer.decay = self.decay
 
-        if self.validation_size is None or self.validation_size  == 0.0:
-            self.model.fit_generator(self._train_batch_generator(),
-                                     steps_per_epoch=history_size / self.batch_size,
-                                     epochs=self.epochs)
-        else:
-            self.model.fit_generator(self._train_batch_generator(),
-                                     steps_per_epoch=history_size / self.batch_size,
-                                     epochs=self.epochs,
-                                     validation_data=self._validation_batch_generator(),
-                                     validation_steps=100)
+        batches = RatingBatches(users[train], items[train], ratings[train], self.batch_size)
+        validation_data = None
+        if np.any(validation):
+            validation_data = ([users[validation], items[validation]], ratings[validation])
+        self.model.fit_generator(batches,
+                                 steps_per_epoch=len(batches),
+                                 epochs=self.epochs,
+                                 validation_data=validation_data,
+                                 workers=self.workers,
+                                 shuffle=True)
+
+    def export(self) -> ANNInference:
+        """
+        Returns copy of trained model that runs on NumPy only (with the same interactions), so it can be saved
+        and served by a process that never imports Keras
+        """
+        layers = ["dense_%d" % i for i in range(len(self.dense_sizes))] + ["output"]
+        engine = ANNInference()
+        engine.interactions.load_from(self.interactions)
+        engine.set_weights(self.model.get_layer("user_embedding").get_weights()[0],
+                           self.model.get_layer("item_embedding").get_weights()[0],
+                           [self.model.get_layer(x).get_weights() for x in layers])
+        return engine
 
     def predict_rating(self, user_id: str, item_id: str) -> float:
         if user_id not in self.user_indices:
@@ -131,3 +158,21 @@ class ANNRecs(RecommenderEngine):
             np.array([self.item_indices[item_id]])
         ])
         return prediction[0]
+
+    def predict_ratings(self, user_ids: List[str], item_ids: List[str]) -> np.ndarray:
+        unknown = [x for x in user_ids if x not in self.user_indices]
+        if len(unknown) > 0:
+            raise Exception("Unknown user %s" % unknown[0])
+        users = np.array([self.user_indices[x] for x in user_ids], dtype=np.int64)
+        items = np.array([self.item_indices.get(x, -1) for x in item_ids], dtype=np.int64)
+        ratings = np.zeros(len(users))
+        known = items >= 0
+        if np.any(known):
+            # Single predict call with large batches instead of one call per pair
+            ratings[known] = self.model.predict([users[known], items[known]],
+                                                batch_size=self.PREDICT_BATCH_SIZE).ravel()
+        store = self.interactions
+        for i in np.flatnonzero(~known):
+            # Same fallback as in predict_rating: mean rating of the user
+            ratings[i] = np.mean(store.ratings[store.user_records(store.user_index[user_ids[i]])])
+        return ratings
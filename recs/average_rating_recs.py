@@ -4,6 +4,8 @@ from recs import RecommenderEngine
 from common import avg_update
 from collections import Counter
 
+import numpy as np
+
 
 class AverageRatingRecs(RecommenderEngine):
     def __init__(self):
@@ -24,10 +26,42 @@ class AverageRatingRecs(RecommenderEngine):
             self.item_average_rating[item_id] = avg_update(self.item_average_rating[item_id], current_count, rating)
         self.global_rating_count += 1
         self.global_average = avg_update(self.global_average, self.global_rating_count, rating)
-        super().add_data(user_id, item_id, rating)
+        super().add_data(user_id, item_id, rating, timestamp)
+
+    def add_data_columns(self, columns):
+        super().add_data_columns(columns)
+        if len(columns) == 0:
+            return
+        items, inverse = np.unique(columns.item_ids, return_inverse=True)
+        counts = np.bincount(inverse)
+        sums = np.bincount(inverse, weights=columns.ratings)
+        for item_id, count, total in zip(items.tolist(), counts.tolist(), sums.tolist()):
+            old_count = self.item_rating_count[item_id]
+            self.item_rating_count[item_id] = old_count + count
+            self.item_average_rating[item_id] = \
+                (self.item_average_rating[item_id] * old_count + total) / (old_count + count)
+        total = float(np.sum(columns.ratings, dtype=np.float64))
+        self.global_average = (self.global_average * self.global_rating_count + total) / \
+            (self.global_rating_count + len(columns))
+        self.global_rating_count += len(columns)
+
+    def build(self):
+        # Averages are maintained by add_data; here they are recomputed from scratch (e.g. after restoring snapshot)
+        store = self.interactions
+        counts = np.bincount(store.items, minlength=store.n_items)
+        sums = np.bincount(store.items, weights=store.ratings, minlength=store.n_items)
+        self.item_rating_count = Counter(dict(zip(store.item_ids, counts.tolist())))
+        self.item_average_rating = Counter(dict(zip(store.item_ids, (sums / np.maximum(counts, 1)).tolist())))
+        self.global_rating_count = len(store)
+        if len(store) > 0:
+            self.global_average = float(np.mean(store.ratings))
 
     def predict_rating(self, user_id: str, item_id: str):
         return self.item_average_rating.get(item_id, self.global_average)
 
+    def predict_ratings(self, user_ids, item_ids):
+        averages = self.item_average_rating
+        return np.array([averages.get(x, self.global_average) for x in item_ids], dtype=np.float64)
+
     def predict_interests(self, user_id: str, n: int = 5):
         return [x for x, _ in self.item_average_rating.most_common(n)]
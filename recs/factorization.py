@@ -0,0 +1,129 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix
+
+# Factorization result: (ut, s, vt), where ut is (components x rows), s is (components,), vt is (components x cols).
+# Components are sorted by decreasing singular value. This is the layout sparsesvd returns.
+SVDResult = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+class Factorization:
+    """
+    Truncated SVD backend for SVDBasedCF
+    """
+    def factorize(self, matrix: csc_matrix, components: int) -> SVDResult:
+        raise NotImplementedError()
+
+
+class SparseSVDFactorization(Factorization):
+    """
+    SVDLIBC via sparsesvd package. Single-threaded, exact.
+    """
+    def factorize(self, matrix: csc_matrix, components: int) -> SVDResult:
+        # Imported lazily, so other backends work without sparsesvd installed
+        from sparsesvd import sparsesvd
+        return sparsesvd(csc_matrix(matrix), components)
+
+
+class ScipySVDSFactorization(Factorization):
+    """
+    ARPACK via scipy.sparse.linalg.svds. Requires components < min(matrix.shape).
+    """
+    def __init__(self, tol: float = 0.0):
+        self.tol = tol
+
+    def factorize(self, matrix: csc_matrix, components: int) -> SVDResult:
+        from scipy.sparse.linalg import svds
+        components = min(components, min(matrix.shape) - 1)
+        u, s, vt = svds(csc_matrix(matrix, dtype=np.float64), k=components, tol=self.tol)
+        order = np.argsort(-s)
+        return u[:, order].T, s[order], vt[order]
+
+
+class RandomizedSVDFactorization(Factorization):
+    """
+    Randomized range finder with power iterations, as described in
+    {Halko, N., Martinsson, P. G., & Tropp, J. A. (2011). Finding structure with randomness: Probabilistic algorithms for constructing approximate matrix decompositions. https://doi.org/10.1137/090771806}
+    Sparse-dense products are split into row blocks and computed on a thread pool of <n_jobs> threads
+    (scipy sparse kernels and BLAS release the GIL).
+    """
+    def __init__(self, oversamples: int = 10, power_iterations: int = 4, n_jobs: int = 1, seed: int = 42):
+        self.oversamples = oversamples
+        self.power_iterations = power_iterations
+        self.n_jobs = n_jobs
+        self.seed = seed
+
+    def _row_blocks(self, matrix: csr_matrix):
+        bounds = np.linspace(0, matrix.shape[0], self.n_jobs + 1).astype(int)
+        return [(a, b, matrix[a:b]) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    def factorize(self, matrix: csc_matrix, components: int) -> SVDResult:
+        matrix = csr_matrix(matrix, dtype=np.float64)
+        rank = min(components + self.oversamples, min(matrix.shape))
+        blocks = self._row_blocks(matrix)
+        rng = np.random.RandomState(self.seed)
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+            def dot(x: np.ndarray) -> np.ndarray:
+                # matrix . x
+                return np.vstack(list(pool.map(lambda blk: blk[2].dot(x), blocks)))
+
+            def t_dot(x: np.ndarray) -> np.ndarray:
+                # matrix.T . x
+                return sum(pool.map(lambda blk: blk[2].T.dot(x[blk[0]:blk[1]]), blocks))
+
+            q, _ = np.linalg.qr(dot(rng.normal(size=(matrix.shape[1], rank))))
+            for _ in range(self.power_iterations):
+                # Re-orthonormalizing on each step for numerical stability
+                q, _ = np.linalg.qr(t_dot(q))
+                q, _ = np.linalg.qr(dot(q))
+            b = t_dot(q).T
+        u_b, s, vt = np.linalg.svd(b, full_matrices=False)
+        u = q.dot(u_b)
+        return u[:, :components].T, s[:components], vt[:components]
+
+
+class CachedPrefixFactorization(Factorization):
+    """
+    Computes <max_components> components once and answers requests for fewer components with truncated prefixes,
+    as long as the matrix stays the same (e.g. during cross-validation over number of components).
+    """
+    def __init__(self, factorization: Factorization, max_components: int):
+        self.factorization = factorization
+        self.max_components = max_components
+        self._fingerprint = None  # type: str
+        self._result = None  # type: SVDResult
+
+    @staticmethod
+    def fingerprint(matrix: csc_matrix) -> str:
+        matrix = csc_matrix(matrix)
+        h = hashlib.sha1(str(matrix.shape).encode())
+        for array in [matrix.indptr, matrix.indices, matrix.data]:
+            h.update(np.ascontiguousarray(array).data)
+        return h.hexdigest()
+
+    def factorize(self, matrix: csc_matrix, components: int) -> SVDResult:
+        fingerprint = self.fingerprint(matrix)
+        if fingerprint != self._fingerprint or len(self._result[1]) < components:
+            self._result = self.factorization.factorize(matrix, max(components, self.max_components))
+            self._fingerprint = fingerprint
+        ut, s, vt = self._result
+        return ut[:components], s[:components], vt[:components]
+
+
+def reconstruction_error(matrix: csc_matrix, factors: SVDResult, block_size: int = 1000000) -> float:
+    """
+    Relative Frobenius error of the factorization on non-zero entries of the matrix
+    """
+    ut, s, vt = factors
+    coo = matrix.tocoo()
+    scaled_ut = ut * s[:, None]
+    squared_error = 0.0
+    for start in range(0, coo.nnz, block_size):
+        rows, cols = coo.row[start:start + block_size], coo.col[start:start + block_size]
+        predicted = np.einsum("ij,ij->j", scaled_ut[:, rows], vt[:, cols])
+        squared_error += np.sum((coo.data[start:start + block_size] - predicted) ** 2)
+    return float(np.sqrt(squared_error) / (np.sqrt(np.sum(coo.data ** 2)) + 1e-12))
@@ -1,44 +1,59 @@
-from collections import Counter
+from typing import List
+
 from recs import RecommenderEngine
+from recs.matrix_builder import MatrixBuilder, compressed_entries
+from recs.ranking import top_n_indices, top_n_per_group
+import numpy as np
+from scipy.sparse import csr_matrix
 
 
 class HeuristicRE(RecommenderEngine):
-    def __init__(self):
+    """
+    Influence of item i on item j is average deviation of rating of j from user's average rating, over users who
+    rated both. Only users with at most MAX_HISTORY_SIZE ratings are considered.
+    With binary rating matrix B and demeaned rating matrix D, sums of deviations are (B^T D)[i, j], and they are
+    divided by number of (i, other item) pairs in histories. Each row of influence matrix is pruned to <top_k>
+    largest entries.
+    Interests are items with the largest sum of influences of items that user has rated.
+    """
+    MAX_HISTORY_SIZE = 50
+
+    def __init__(self, top_k: int = 100):
         super().__init__()
-        self.item_item_influence = None
+        self.top_k = top_k
+        # Rows are influencing items, columns are influenced ones (item indices of interaction store)
+        self.item_item_influence = None  # type: csr_matrix
+        self.item_ids = np.zeros(0, dtype=object)  # type: np.ndarray
 
     def build(self):
-        self.item_item_influence = dict()
-        item_interactions = Counter()
-        for _, ratings in self.user_histories.items():
-            if len(ratings) > 50:
-                continue
-            if len(ratings) == 0:
-                continue
-            user_avg_rating = sum([r.rating for r in ratings]) / len(ratings)
-            for r in ratings:
-                for r2 in ratings:
-                    if r != r2:
-                        if r.item_id not in self.item_item_influence:
-                            self.item_item_influence[r.item_id] = dict()
-                        if r2.item_id not in self.item_item_influence[r.item_id]:
-                            self.item_item_influence[r.item_id][r2.item_id] = 0
-                        self.item_item_influence[r.item_id][r2.item_id] += r2.rating - user_avg_rating
-                        item_interactions[r.item_id] += 1
-
-        for key, recs in self.item_item_influence.items():
-            for k in recs.keys():
-                recs[k] = recs[k] / item_interactions[key]
-
-    def predict_interests(self, user_id: str):
-        already_seen = set()
-        recs = Counter()
-        for r in self.user_histories.get(user_id, []):
-            already_seen.add(r.item_id)
-            for rec, value in self.item_item_influence.get(r.item_id, {}).items():
-                recs[rec] += value
+        matrix = MatrixBuilder.from_interactions(self.interactions, MatrixBuilder.CORRECTION_USER_MEAN)
+        demeaned = matrix.tocsr()
+        n_items = demeaned.shape[1]
+        history_sizes = np.diff(demeaned.indptr)
+        demeaned = demeaned[np.flatnonzero(history_sizes <= self.MAX_HISTORY_SIZE)]
+        history_sizes = np.diff(demeaned.indptr)
+        rated = csr_matrix((np.ones(demeaned.nnz), demeaned.indices, demeaned.indptr), shape=demeaned.shape)
 
-        for i in already_seen:
-            recs.pop(i, None)
+        influence = rated.T.tocsr().dot(demeaned).tocoo()
+        # Number of pairs (item, other item) in histories, for each item
+        pairs = np.bincount(demeaned.indices, weights=np.repeat(history_sizes - 1, history_sizes), minlength=n_items)
+        rows, cols = influence.row, influence.col
+        keep = rows != cols
+        rows, cols, values = rows[keep], cols[keep], influence.data[keep] / pairs[rows[keep]]
+        keep = top_n_per_group(rows, values, self.top_k)
+        self.item_item_influence = csr_matrix((values[keep], (rows[keep], cols[keep])), shape=(n_items, n_items))
+        self.item_ids = np.array(self.interactions.item_ids[:n_items], dtype=object)
 
-        return [x for _, x in recs.most_common(5)]
+    def predict_interests(self, user_id: str, n: int = 5) -> List[str]:
+        user_index = self.interactions.user_index.get(user_id)
+        if user_index is None or self.item_item_influence is None:
+            return []
+        seen = np.unique(self.interactions.items[self.interactions.user_records(user_index)])
+        seen = seen[seen < len(self.item_ids)]
+        positions, _ = compressed_entries(self.item_item_influence.indptr, seen)
+        cols = self.item_item_influence.indices[positions]
+        scores = np.full(len(self.item_ids), -np.inf)
+        scores[cols] = 0.0
+        scores += np.bincount(cols, weights=self.item_item_influence.data[positions], minlength=len(self.item_ids))
+        scores[seen] = -np.inf
+        return self.item_ids[top_n_indices(scores, n)].tolist()
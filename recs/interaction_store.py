@@ -0,0 +1,370 @@
+import sys
+from collections.abc import Mapping
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from common import ItemRating
+
+
+class GroupIndex:
+    """
+    CSR-like grouping of record positions by an integer key column (user index or item index).
+    Positions of the records with key k are order[indptr[k]:indptr[k + 1]], in insertion order.
+    Only the first <size> records of the store are covered; newer records live in the "tail" and are scanned.
+    """
+    def __init__(self, keys: np.ndarray, n_groups: int):
+        # mergesort is stable, so records of each group stay in insertion (i.e. time) order
+        self.order = np.argsort(keys, kind="mergesort")
+        self.indptr = np.zeros(n_groups + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=n_groups), out=self.indptr[1:])
+        self.size = len(keys)
+
+    @classmethod
+    def from_arrays(cls, order: np.ndarray, indptr: np.ndarray) -> "GroupIndex":
+        index = cls.__new__(cls)
+        index.order = order
+        index.indptr = indptr
+        index.size = len(order)
+        return index
+
+    def group(self, key: int) -> np.ndarray:
+        if key + 1 >= len(self.indptr):
+            return self.order[:0]
+        return self.order[self.indptr[key]:self.indptr[key + 1]]
+
+    def group_sizes(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    @property
+    def nbytes(self) -> int:
+        return self.order.nbytes + self.indptr.nbytes
+
+
+class InteractionStore:
+    """
+    Append-only columnar storage for rating events.
+    User and item ids are interned into dense integer indices (in order of first appearance), and each event is
+    kept as a row of four contiguous columns: int32 user index, int32 item index, float32 rating and int64 timestamp.
+    Columns are growable buffers with amortized O(1) appends.
+
+    Lookups by user and by item go through GroupIndex (CSR/CSC-style views). Indices are rebuilt lazily: records
+    appended after the last rebuild are found by a vectorized scan of the tail, and the index is rebuilt once the
+    tail grows too large. That keeps online appends (the /rate endpoint) cheap.
+    """
+    MIN_CAPACITY = 1024
+    # Tail is re-indexed when it exceeds this fraction of indexed records (or MIN_CAPACITY records)
+    MAX_TAIL_FRACTION = 0.125
+
+    def __init__(self, capacity: int = MIN_CAPACITY):
+        capacity = max(capacity, 1)
+        self.user_ids = []  # type: List[str]
+        self.item_ids = []  # type: List[str]
+        self.user_index = dict()  # type: Dict[str, int]
+        self.item_index = dict()  # type: Dict[str, int]
+        self._users = np.empty(capacity, dtype=np.int32)
+        self._items = np.empty(capacity, dtype=np.int32)
+        self._ratings = np.empty(capacity, dtype=np.float32)
+        self._timestamps = np.empty(capacity, dtype=np.int64)
+        self._size = 0
+        self._by_user = None  # type: Optional[GroupIndex]
+        self._by_item = None  # type: Optional[GroupIndex]
+        # Number of records of each item; computed on first use and maintained on appends
+        self._item_counts = None  # type: Optional[np.ndarray]
+        self._max_timestamp = None  # type: Optional[int]
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def n_users(self) -> int:
+        return len(self.user_ids)
+
+    @property
+    def n_items(self) -> int:
+        return len(self.item_ids)
+
+    # Column views. They are not copies, so callers should not keep them across appends.
+    @property
+    def users(self) -> np.ndarray:
+        return self._users[:self._size]
+
+    @property
+    def items(self) -> np.ndarray:
+        return self._items[:self._size]
+
+    @property
+    def ratings(self) -> np.ndarray:
+        return self._ratings[:self._size]
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._timestamps[:self._size]
+
+    def _reserve(self, extra: int):
+        required = self._size + extra
+        capacity = len(self._users)
+        if required <= capacity:
+            return
+        capacity = max(required, capacity * 2, self.MIN_CAPACITY)
+        for name in ["_users", "_items", "_ratings", "_timestamps"]:
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def _intern(self, ids: List[str], index: Dict[str, int], value: str) -> int:
+        idx = index.get(value)
+        if idx is None:
+            idx = len(ids)
+            ids.append(value)
+            index[value] = idx
+        return idx
+
+    def _intern_many(self, ids: List[str], index: Dict[str, int], values) -> np.ndarray:
+        # Interning unique values only, in order of their first appearance in the batch
+        uniq, first, inverse = np.unique(np.asarray(values, dtype=str), return_index=True, return_inverse=True)
+        codes = np.empty(len(uniq), dtype=np.int32)
+        for pos in np.argsort(first, kind="mergesort"):
+            codes[pos] = self._intern(ids, index, uniq[pos].item())
+        return codes[inverse.ravel()]
+
+    def append(self, user_id: str, item_id: str, rating: float, timestamp: int = 0) -> int:
+        """
+        Adds single record and returns its position
+        """
+        self._reserve(1)
+        pos = self._size
+        self._users[pos] = self._intern(self.user_ids, self.user_index, user_id)
+        self._items[pos] = self._intern(self.item_ids, self.item_index, item_id)
+        self._ratings[pos] = rating
+        self._timestamps[pos] = timestamp
+        self._count_items(self._items[pos:pos + 1])
+        if self._max_timestamp is not None and timestamp > self._max_timestamp:
+            self._max_timestamp = int(timestamp)
+        # Size is published last, so concurrent readers never see half-written record
+        self._size = pos + 1
+        return pos
+
+    def extend(self, user_ids: Iterable[str], item_ids: Iterable[str], ratings: Iterable[float],
+               timestamps: Optional[Iterable[int]] = None):
+        """
+        Adds batch of records given as parallel sequences (lists or arrays)
+        """
+        ratings = np.asarray(ratings, dtype=np.float32)
+        n = len(ratings)
+        if n == 0:
+            return
+        users = self._intern_many(self.user_ids, self.user_index, user_ids)
+        items = self._intern_many(self.item_ids, self.item_index, item_ids)
+        self._reserve(n)
+        self._users[self._size:self._size + n] = users
+        self._items[self._size:self._size + n] = items
+        self._ratings[self._size:self._size + n] = ratings
+        self._timestamps[self._size:self._size + n] = 0 if timestamps is None else np.asarray(timestamps)
+        self._count_items(items)
+        if self._max_timestamp is not None:
+            self._max_timestamp = max(self._max_timestamp, int(np.max(self._timestamps[self._size:self._size + n])))
+        self._size += n
+
+    def _count_items(self, items: np.ndarray):
+        counts = self._item_counts
+        if counts is None:
+            return
+        if len(counts) < self.n_items:
+            grown = np.zeros(max(self.n_items, 2 * len(counts)), dtype=np.int64)
+            grown[:len(counts)] = counts
+            counts = grown
+        np.add.at(counts, items, 1)
+        self._item_counts = counts
+
+    def max_timestamp(self) -> Optional[int]:
+        """
+        Latest timestamp among records (None for empty store), in O(1) after the first call
+        """
+        if self._size == 0:
+            return None
+        if self._max_timestamp is None:
+            self._max_timestamp = int(np.max(self.timestamps))
+        return self._max_timestamp
+
+    def contains(self, user_id: str, item_id: str, rating: float, timestamp: int) -> bool:
+        """
+        Checks if exactly this record is in the store; costs O(number of user's records)
+        """
+        user = self.user_index.get(user_id)
+        item = self.item_index.get(item_id)
+        if user is None or item is None:
+            return False
+        positions = self.user_records(user)
+        return bool(np.any((self._items[positions] == item) & (self._timestamps[positions] == timestamp) &
+                           (self._ratings[positions] == np.float32(rating))))
+
+    def item_count(self, item_id: str) -> int:
+        """
+        Number of records of given item (0 for unknown items), in O(1)
+        """
+        idx = self.item_index.get(item_id)
+        if idx is None:
+            return 0
+        counts = self._item_counts
+        if counts is None:
+            counts = np.bincount(self.items, minlength=self.n_items).astype(np.int64)
+            self._item_counts = counts
+        return int(counts[idx]) if idx < len(counts) else 0
+
+    def _group_index(self, attr: str, column: np.ndarray, n_groups: int) -> GroupIndex:
+        index = getattr(self, attr)
+        if index is None or self._size - index.size > max(self.MIN_CAPACITY, index.size * self.MAX_TAIL_FRACTION):
+            index = GroupIndex(column[:self._size], n_groups)
+            setattr(self, attr, index)
+        return index
+
+    def _records_of(self, attr: str, column: np.ndarray, n_groups: int, key: int) -> np.ndarray:
+        size = self._size
+        index = self._group_index(attr, column, n_groups)
+        positions = index.group(key)
+        if index.size < size:
+            tail = np.flatnonzero(column[index.size:size] == key)
+            if len(tail) > 0:
+                positions = np.concatenate([positions, tail + index.size])
+        return positions
+
+    def user_records(self, user_index: int) -> np.ndarray:
+        """
+        Positions of records of given user (by interned index), in insertion order
+        """
+        return self._records_of("_by_user", self._users, self.n_users, user_index)
+
+    def item_records(self, item_index: int) -> np.ndarray:
+        """
+        Positions of records of given item (by interned index), in insertion order
+        """
+        return self._records_of("_by_item", self._items, self.n_items, item_index)
+
+    def by_user(self) -> GroupIndex:
+        """
+        Returns CSR-style view of all records grouped by user index
+        """
+        if self._by_user is None or self._by_user.size != self._size:
+            self._by_user = GroupIndex(self.users, self.n_users)
+        return self._by_user
+
+    def by_item(self) -> GroupIndex:
+        """
+        Returns CSC-style view of all records grouped by item index
+        """
+        if self._by_item is None or self._by_item.size != self._size:
+            self._by_item = GroupIndex(self.items, self.n_items)
+        return self._by_item
+
+    def records(self, positions: np.ndarray) -> List[ItemRating]:
+        """
+        Materializes records at given positions as ItemRating objects
+        """
+        return [ItemRating(self.user_ids[u], self.item_ids[i], r, t) for u, i, r, t in zip(
+            self._users[positions].tolist(), self._items[positions].tolist(),
+            self._ratings[positions].tolist(), self._timestamps[positions].tolist()
+        )]
+
+    def load_from(self, other: "InteractionStore", size: Optional[int] = None):
+        """
+        Replaces contents with copy of the first <size> records of other store (all records by default).
+        Safe to call while other store is being appended to by another thread.
+        """
+        size = len(other) if size is None else size
+        # Ids are interned before record is published, so all ids referenced by first <size> records are there
+        self.user_ids = other.user_ids[:len(other.user_ids)]
+        self.item_ids = other.item_ids[:len(other.item_ids)]
+        self.user_index = {x: i for i, x in enumerate(self.user_ids)}
+        self.item_index = {x: i for i, x in enumerate(self.item_ids)}
+        self._users = np.array(other._users[:size])
+        self._items = np.array(other._items[:size])
+        self._ratings = np.array(other._ratings[:size])
+        self._timestamps = np.array(other._timestamps[:size])
+        self._size = size
+        self._by_user = None
+        self._by_item = None
+        self._item_counts = None
+        self._max_timestamp = None
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        """
+        Returns arrays describing the store (for snapshots). Ids are stored as fixed-width strings.
+        """
+        by_user, by_item = self.by_user(), self.by_item()
+        return {
+            "users": self.users, "items": self.items, "ratings": self.ratings, "timestamps": self.timestamps,
+            "user_ids": np.array(self.user_ids, dtype=str), "item_ids": np.array(self.item_ids, dtype=str),
+            "by_user_order": by_user.order, "by_user_indptr": by_user.indptr,
+            "by_item_order": by_item.order, "by_item_indptr": by_item.indptr,
+        }
+
+    def set_state(self, state: Dict[str, np.ndarray]):
+        """
+        Restores the store from get_state() arrays. Arrays are used without copying (e.g. memory-mapped);
+        columns are copied into writable buffers on first append only.
+        """
+        self.user_ids = state["user_ids"].tolist()
+        self.item_ids = state["item_ids"].tolist()
+        self.user_index = {x: i for i, x in enumerate(self.user_ids)}
+        self.item_index = {x: i for i, x in enumerate(self.item_ids)}
+        self._users = state["users"]
+        self._items = state["items"]
+        self._ratings = state["ratings"]
+        self._timestamps = state["timestamps"]
+        self._size = len(self._users)
+        self._by_user = GroupIndex.from_arrays(state["by_user_order"], state["by_user_indptr"])
+        self._by_item = GroupIndex.from_arrays(state["by_item_order"], state["by_item_indptr"])
+        self._item_counts = None
+        self._max_timestamp = None
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Returns approximate memory footprint in bytes, broken down by component
+        """
+        columns = self._users.nbytes + self._items.nbytes + self._ratings.nbytes + self._timestamps.nbytes
+        indices = sum([x.nbytes for x in [self._by_user, self._by_item] if x is not None])
+        ids = sys.getsizeof(self.user_ids) + sys.getsizeof(self.item_ids) + \
+            sys.getsizeof(self.user_index) + sys.getsizeof(self.item_index) + \
+            sum([sys.getsizeof(x) for x in self.user_ids]) + sum([sys.getsizeof(x) for x in self.item_ids])
+        return {
+            "columns": columns,
+            "indices": indices,
+            "ids": ids,
+            "total": columns + indices + ids
+        }
+
+
+class HistoryView(Mapping):
+    """
+    Read-only Dict[str, List[ItemRating]] facade over InteractionStore, grouped either by user or by item.
+    This keeps code that iterates user_histories / item_histories working. Records are materialized on access,
+    so prefer the store's columns in hot paths.
+    """
+    def __init__(self, store: InteractionStore, by_user: bool = True):
+        self.store = store
+        self.by_user = by_user
+
+    def _ids(self) -> List[str]:
+        return self.store.user_ids if self.by_user else self.store.item_ids
+
+    def _index(self) -> Dict[str, int]:
+        return self.store.user_index if self.by_user else self.store.item_index
+
+    def __getitem__(self, key: str) -> List[ItemRating]:
+        idx = self._index()[key]
+        if self.by_user:
+            return self.store.records(self.store.user_records(idx))
+        else:
+            return self.store.records(self.store.item_records(idx))
+
+    def __contains__(self, key) -> bool:
+        return key in self._index()
+
+    def __iter__(self):
+        ids = self._ids()
+        return iter(ids[:len(ids)])
+
+    def __len__(self) -> int:
+        return len(self._ids())
@@ -1,28 +1,144 @@
-from collections import Counter
+from typing import List
 
+from common.snapshot import SnapshotError
 from recs import RecommenderEngine
-from scipy.sparse import csc_matrix, dok_matrix
-from collections import Counter
+from recs.matrix_builder import MatrixBuilder, compressed_entries
+from recs.ranking import top_n_indices, top_n_indices_batch
+import numpy as np
+from scipy.sparse import csr_matrix
 
 
 class ItemCF(RecommenderEngine):
-    def __init__(self, consider_top_users = 1000):
+    """
+    Item-based collaborative filtering, as described in
+    {Sarwar, B., Karypis, G., Konstan, J., & Reidl, J. (2001). Item-based collaborative filtering recommendation algorithms. Proceedings of the Tenth International Conference on World Wide Web  - WWW ’01, 285–295. https://doi.org/10.1145/371920.372071}
+
+    Similarity of items is adjusted cosine: cosine of item columns of the rating matrix with user averages subtracted.
+    It is computed with sparse matrix products in blocks of items, using only <consider_top_users> users with most
+    ratings. Only <neighbours> most similar (positively) items are kept for each item, in CSR matrix
+    (rows are items, columns are their neighbours), which is all the model needs at serving time.
+
+    Rating is predicted as average of user's ratings of item's neighbours, weighted by similarity.
+    Interests are items with the highest sum of similarities to rated items, weighted by ratings.
+    """
+    # Size (number of entries) of dense similarity blocks computed in build()
+    BLOCK_SIZE = 2 ** 22
+
+    def __init__(self, consider_top_users: int = 1000, neighbours: int = 50):
         super().__init__()
         self.consider_top_users = consider_top_users
+        self.neighbours = neighbours
+        self.global_average = 2.5
+        self.rating_matrix = None  # type: MatrixBuilder
+        # Raw ratings (rows are users, columns are items) and keys (row * n_items + column) of their entries
+        self.ratings = None  # type: csr_matrix
+        self.rating_keys = np.zeros(0, dtype=np.int64)  # type: np.ndarray
+        self.similarities = None  # type: csr_matrix
+        self.item_ids = np.zeros(0, dtype=object)  # type: np.ndarray
+
+    def _init_ratings(self) -> csr_matrix:
+        """
+        Builds rating lookups from interactions. Returns rating matrix with user averages subtracted.
+        """
+        self.rating_matrix = MatrixBuilder.from_interactions(self.interactions, MatrixBuilder.CORRECTION_USER_MEAN)
+        demeaned = self.rating_matrix.tocsr()
+        rows = np.repeat(np.arange(demeaned.shape[0], dtype=np.int64), np.diff(demeaned.indptr))
+        self.ratings = csr_matrix((demeaned.data + self.rating_matrix.user_avg[rows], demeaned.indices,
+                                   demeaned.indptr), shape=demeaned.shape)
+        # Entries of CSR matrix are sorted by (row, column), so keys are sorted too
+        self.rating_keys = rows * demeaned.shape[1] + demeaned.indices
+        self.global_average = float(np.mean(self.ratings.data)) if self.ratings.nnz > 0 else 2.5
+        self.item_ids = np.array(self.interactions.item_ids[:demeaned.shape[1]], dtype=object)
+        return demeaned
 
     def build(self):
-        user_history_lens = Counter({u: len(hist) for u, hist in self.user_histories.items()})
-
-        user_row_index = dict()  # type: Dict[str, int]
-        item_col_index = dict()  # type: Dict[str, int]
-
-        for user_id, _ in user_history_lens.most_common(self.consider_top_users):
-            for record in self.user_histories.get(user_id, []):
-                item_col_index[record.item_id] = col_index
-                avg_rating = np.mean([x.rating for x in histories])
-                self.item_average_rating[item_id] = avg_rating
-                for record in histories:
-                    row_index = user_row_index.get(record.user_id, len(user_row_index))
-                    user_row_index[record.user_id] = row_index
-                    m[row_index, col_index] = record.rating - avg_rating
-        self.global_average = np.mean(list(self.item_average_rating.values()))
\ No newline at end of file
+        demeaned = self._init_ratings()
+        n_users, n_items = demeaned.shape
+        if self.consider_top_users < n_users:
+            top_users = np.argsort(-np.diff(demeaned.indptr), kind="mergesort")[:self.consider_top_users]
+            demeaned = demeaned[np.sort(top_users)]
+
+        # Normalized item vectors: rows are items
+        vectors = demeaned.T.tocsr()
+        norms = np.sqrt(np.bincount(np.repeat(np.arange(n_items), np.diff(vectors.indptr)),
+                                    weights=vectors.data ** 2, minlength=n_items))
+        vectors.data = vectors.data / np.repeat(np.where(norms > 0, norms, 1.0), np.diff(vectors.indptr))
+        vectors_t = vectors.T.tocsr()
+
+        block = max(1, self.BLOCK_SIZE // max(n_items, 1))
+        indices = [np.zeros(0, dtype=np.int64)]  # type: List[np.ndarray]
+        data = [np.zeros(0)]  # type: List[np.ndarray]
+        lengths = []  # type: List[int]
+        for start in range(0, n_items, block):
+            end = min(start + block, n_items)
+            similarities = vectors[start:end].dot(vectors_t).toarray()
+            similarities[similarities <= 0] = -np.inf
+            similarities[np.arange(end - start), np.arange(start, end)] = -np.inf
+            for row, top in zip(similarities, top_n_indices_batch(similarities, self.neighbours)):
+                indices.append(top)
+                data.append(row[top])
+                lengths.append(len(top))
+        self.similarities = csr_matrix((np.concatenate(data), np.concatenate(indices), np.r_[0, np.cumsum(lengths)]),
+                                       shape=(n_items, n_items))
+        print("Item similarities built")
+
+    def _get_model_state(self):
+        params = {"consider_top_users": self.consider_top_users, "neighbours": self.neighbours}
+        if self.similarities is None:
+            return {}, params
+        arrays = {
+            "similarity_indptr": self.similarities.indptr,
+            "similarity_indices": self.similarities.indices,
+            "similarity_data": self.similarities.data
+        }
+        return arrays, params
+
+    def _set_model_state(self, arrays, params):
+        if params["consider_top_users"] != self.consider_top_users or params["neighbours"] != self.neighbours:
+            raise SnapshotError("Snapshot was made with other ItemCF parameters: %s" % params)
+        if "similarity_indptr" not in arrays:
+            return
+        self._init_ratings()
+        n_items = len(arrays["similarity_indptr"]) - 1
+        self.similarities = csr_matrix((arrays["similarity_data"], arrays["similarity_indices"],
+                                        arrays["similarity_indptr"]), shape=(n_items, n_items))
+
+    def predict_rating(self, user_id: str, item_id: str):
+        return float(self.predict_ratings([user_id], [item_id])[0])
+
+    def predict_ratings(self, user_ids: List[str], item_ids: List[str]) -> np.ndarray:
+        rows = np.array([self.rating_matrix.user_row_index.get(x, -1) for x in user_ids], dtype=np.int64)
+        cols = np.array([self.rating_matrix.item_col_index.get(x, -1) for x in item_ids], dtype=np.int64)
+        # Fallbacks: user's average rating, item's average rating for unknown users, or global average
+        item_avg = np.append(self.rating_matrix.item_avg, self.global_average)
+        predictions = item_avg[np.where(cols >= 0, cols, len(item_avg) - 1)]
+        known_users = rows >= 0
+        predictions[known_users] = self.rating_matrix.user_avg[rows[known_users]]
+        pairs = np.flatnonzero(known_users & (cols >= 0))
+
+        # User's ratings of neighbours of each item are found by binary search of their keys
+        positions, segments = compressed_entries(self.similarities.indptr, cols[pairs])
+        keys = rows[pairs][segments] * self.ratings.shape[1] + self.similarities.indices[positions]
+        found = np.searchsorted(self.rating_keys, keys).clip(0, max(len(self.rating_keys) - 1, 0))
+        rated = self.rating_keys[found] == keys if len(self.rating_keys) > 0 else np.zeros(len(keys), dtype=bool)
+        weights = np.where(rated, self.similarities.data[positions], 0.0)
+        totals = np.bincount(segments, weights=weights * self.ratings.data[found], minlength=len(pairs))
+        norms = np.bincount(segments, weights=weights, minlength=len(pairs))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            predictions[pairs] = np.where(norms > 0, totals / norms, predictions[pairs])
+        return predictions
+
+    def predict_interests(self, user_id: str, n: int = 5) -> List[str]:
+        row = self.rating_matrix.user_row_index.get(user_id)
+        if row is None:
+            return []
+        start, end = self.ratings.indptr[row], self.ratings.indptr[row + 1]
+        cols = self.ratings.indices[start:end]
+        positions, segments = compressed_entries(self.similarities.indptr, cols)
+        scores = np.bincount(self.similarities.indices[positions], minlength=len(self.item_ids),
+                             weights=self.similarities.data[positions] * self.ratings.data[start:end][segments])
+        # Excluding seen items (including ones rated after build) and items unrelated to user's ones
+        seen = self.interactions.items[self.interactions.user_records(self.interactions.user_index[user_id])]
+        scores[seen[seen < len(scores)]] = -np.inf
+        scores[scores <= 0] = -np.inf
+        return self.item_ids[top_n_indices(scores, n)].tolist()
@@ -1,24 +1,116 @@
-from typing import Dict, List
+from typing import List, Optional, Tuple
 
-from scipy.sparse import dok_matrix
+from scipy.sparse import coo_matrix, csc_matrix, csr_matrix
 import numpy as np
 
-from common import ItemRating
+from .interaction_store import InteractionStore
+
+
+def compressed_entries(indptr: np.ndarray, groups: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns positions of entries of given rows (or columns) of compressed sparse matrix, and index of group
+    (in <groups>) of each entry
+    """
+    starts = indptr[groups]
+    lengths = indptr[groups + 1] - starts
+    segments = np.repeat(np.arange(len(groups)), lengths)
+    offsets = np.arange(len(segments)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts[segments] + offsets, segments
 
 
 class MatrixBuilder:
-    def __init__(self, user_histories: Dict[str, List[ItemRating]], item_histories: Dict[str, List[ItemRating]]):
-        self.m = dok_matrix((len(user_histories), len(item_histories)))
-        self.item_avg_rating = {x: np.mean([r.rating for r in y]) for x, y in item_histories.items()}  # type: Dict[str, float]
-        self.user_avg_rating = {x: np.mean([r.rating for r in y]) for x, y in user_histories.items()}  # type: Dict[str, float]
-        self.user_row_index = dict()  # type: Dict[str, int]
-        self.item_col_index = dict()  # type: Dict[str, int]
-        for col_index, (item_id, histories) in enumerate(item_histories.items()):
-            self.item_col_index[item_id] = col_index
-            for record in histories:
-                row_index = self.user_row_index.get(record.user_id, len(self.user_row_index))
-                self.user_row_index[record.user_id] = row_index
-                self.m[row_index, col_index] = record.rating
+    """
+    Builds sparse user-item rating matrix from id/rating arrays in a single vectorized pass.
+    If user has rated the same item several times, the latest rating is used as the entry, while item and user
+    averages are computed over all ratings (as averages of histories are). Optionally, item or user average rating
+    is subtracted from each entry (correction).
+
+    Matrix is kept in COO form with entries sorted by (row, column), so conversion to CSR/CSC is cheap.
+    """
+    CORRECTION_NONE = "none"
+    CORRECTION_USER_MEAN = "user_mean"
+    CORRECTION_ITEM_MEAN = "item_mean"
+
+    def __init__(self, rows: np.ndarray, cols: np.ndarray, ratings: np.ndarray, shape: Tuple[int, int],
+                 correction: str = CORRECTION_NONE,
+                 user_ids: Optional[List[str]] = None, item_ids: Optional[List[str]] = None):
+        n_rows, n_cols = shape
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        ratings = np.asarray(ratings, dtype=np.float64)
+
+        self.item_avg = self._average(cols, ratings, n_cols)
+        self.user_avg = self._average(rows, ratings, n_rows)
+
+        # Deduplication: np.unique returns first occurrence, so we look through reversed keys to find last rating.
+        # Keys are row-major, so entries end up sorted by (row, col).
+        keys = rows * n_cols + cols
+        _, last_reversed = np.unique(keys[::-1], return_index=True)
+        positions = len(keys) - 1 - last_reversed
+        rows, cols, ratings = rows[positions], cols[positions], ratings[positions]
+        if correction == self.CORRECTION_ITEM_MEAN:
+            values = ratings - self.item_avg[cols]
+        elif correction == self.CORRECTION_USER_MEAN:
+            values = ratings - self.user_avg[rows]
+        elif correction == self.CORRECTION_NONE:
+            values = ratings
+        else:
+            raise ValueError("Unknown correction mode %s" % correction)
+        self.correction = correction
+        self.coo = coo_matrix((values, (rows, cols)), shape=shape)
+        self._csr = None  # type: Optional[csr_matrix]
+        self._csc = None  # type: Optional[csc_matrix]
+
+        # Id -> row (column) index, and -> average rating
+        self.user_row_index = dict()
+        self.item_col_index = dict()
+        self.item_avg_rating = dict()
+        self.user_avg_rating = dict()
+        if user_ids is not None:
+            self.user_row_index = {x: i for i, x in enumerate(user_ids[:n_rows])}
+            self.user_avg_rating = dict(zip(user_ids[:n_rows], self.user_avg))
+        if item_ids is not None:
+            self.item_col_index = {x: i for i, x in enumerate(item_ids[:n_cols])}
+            self.item_avg_rating = dict(zip(item_ids[:n_cols], self.item_avg))
+
+    @classmethod
+    def from_interactions(cls, interactions: InteractionStore, correction: str = CORRECTION_NONE) -> "MatrixBuilder":
+        """
+        Rows and columns of resulting matrix are user and item indices of the store
+        """
+        return cls(interactions.users, interactions.items, interactions.ratings,
+                   (interactions.n_users, interactions.n_items), correction,
+                   interactions.user_ids, interactions.item_ids)
+
+    @staticmethod
+    def _average(index: np.ndarray, ratings: np.ndarray, size: int) -> np.ndarray:
+        counts = np.bincount(index, minlength=size)
+        sums = np.bincount(index, weights=ratings, minlength=size)
+        return sums / np.maximum(counts, 1)
+
+    @property
+    def m(self) -> csr_matrix:
+        return self.tocsr()
+
+    def tocoo(self) -> coo_matrix:
+        return self.coo
+
+    def tocsr(self) -> csr_matrix:
+        if self._csr is None:
+            self._csr = self.coo.tocsr()
+        return self._csr
+
+    def tocsc(self) -> csc_matrix:
+        if self._csc is None:
+            self._csc = self.coo.tocsc()
+        return self._csc
 
     def get_rating(self, user_id: str, item_id: str) -> float:
-        return self.m[self.user_row_index[user_id], self.item_col_index[item_id]]
+        m = self.tocsr()
+        row = self.user_row_index[user_id]
+        col = self.item_col_index[item_id]
+        start, end = m.indptr[row], m.indptr[row + 1]
+        pos = start + np.searchsorted(m.indices[start:end], col)
+        if pos < end and m.indices[pos] == col:
+            return m.data[pos]
+        return 0.0
@@ -0,0 +1,150 @@
+from typing import Optional
+
+import numpy as np
+from scipy.sparse import coo_matrix
+
+from .ranking import top_n_indices
+
+
+class InnerProductIndex:
+    """
+    Index for maximum inner product search (MIPS): given query vector, find n vectors with the highest dot product.
+    Engines build it over item vectors, and query it with user vectors.
+    """
+    def build(self, vectors: np.ndarray):
+        raise NotImplementedError()
+
+    def update(self, indices: np.ndarray, vectors: np.ndarray):
+        """
+        Replaces vectors at given positions (positions should exist in the index)
+        """
+        raise NotImplementedError()
+
+    def search(self, query: np.ndarray, n: int, exclude: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Returns positions of (approximately) top n vectors, best first. Positions from <exclude> are skipped.
+        """
+        raise NotImplementedError()
+
+
+class ExactIndex(InnerProductIndex):
+    """
+    Brute-force scan. Used as a reference for approximate indices.
+    """
+    def __init__(self):
+        self.vectors = None  # type: np.ndarray
+
+    def build(self, vectors: np.ndarray):
+        self.vectors = np.array(vectors)
+
+    def update(self, indices: np.ndarray, vectors: np.ndarray):
+        self.vectors[indices] = vectors
+
+    def search(self, query: np.ndarray, n: int, exclude: Optional[np.ndarray] = None) -> np.ndarray:
+        scores = self.vectors.dot(query)
+        if exclude is not None:
+            scores[exclude] = -np.inf
+        return top_n_indices(scores, n)
+
+
+class IVFIndex(InnerProductIndex):
+    """
+    Inverted file index. Vectors are clustered with k-means into <n_lists> lists; search scans only
+    <n_probe> lists whose centroids are closest to the query.
+
+    Inner product is not a metric, so we use the reduction from
+    {Bachrach, Y. et al. (2014). Speeding Up the Xbox Recommender System Using a Euclidean Transformation for Inner-Product Spaces. https://doi.org/10.1145/2645710.2645741}:
+    each vector x gets extra coordinate sqrt(M^2 - |x|^2), where M is (an upper bound of) the maximal norm, and query
+    gets 0.
+    Then nearest neighbours by euclidean distance are exactly the vectors with maximal inner product.
+    """
+    # Rows processed at once during k-means assignment; bounds memory usage
+    BLOCK_SIZE = 65536
+
+    def __init__(self, n_lists: Optional[int] = None, n_probe: int = 8, iterations: int = 10, seed: int = 42):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.iterations = iterations
+        self.seed = seed
+        self.vectors = None  # type: np.ndarray
+        self.max_norm = 0.0
+        self.centroids = None  # type: np.ndarray
+        self.assignment = None  # type: np.ndarray
+        # Lists in CSR form: members of list k are order[indptr[k]:indptr[k + 1]] for (order, indptr) pair.
+        # The pair is replaced as a whole, so concurrent searches never see mismatched arrays.
+        self.lists = None
+
+    def _augment(self, vectors: np.ndarray) -> np.ndarray:
+        sq_norms = np.sum(vectors ** 2, axis=1)
+        return np.hstack([vectors, np.sqrt(np.maximum(self.max_norm ** 2 - sq_norms, 0.0))[:, None]])
+
+    def _assign(self, x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        # argmin |x - c|^2 == argmax 2 x.c - |c|^2
+        centroid_sq_norms = np.sum(centroids ** 2, axis=1)
+        assignment = np.empty(len(x), dtype=np.int64)
+        for start in range(0, len(x), self.BLOCK_SIZE):
+            block = x[start:start + self.BLOCK_SIZE]
+            assignment[start:start + len(block)] = np.argmax(2 * block.dot(centroids.T) - centroid_sq_norms, axis=1)
+        return assignment
+
+    def _rebuild_lists(self):
+        order = np.argsort(self.assignment, kind="mergesort")
+        indptr = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.assignment, minlength=len(self.centroids)), out=indptr[1:])
+        self.lists = (order, indptr)
+
+    def build(self, vectors: np.ndarray):
+        self.vectors = np.array(vectors)
+        n = len(self.vectors)
+        n_lists = self.n_lists if self.n_lists is not None else int(np.ceil(np.sqrt(n)))
+        n_lists = max(1, min(n_lists, n))
+        self.max_norm = np.sqrt(np.max(np.sum(self.vectors ** 2, axis=1))) if n > 0 else 0.0
+        x = self._augment(self.vectors)
+
+        rng = np.random.RandomState(self.seed)
+        centroids = x[rng.choice(n, n_lists, replace=False)] if n > 0 else np.zeros((1, x.shape[1]))
+        assignment = np.zeros(n, dtype=np.int64)
+        for _ in range(self.iterations):
+            assignment = self._assign(x, centroids)
+            counts = np.bincount(assignment, minlength=len(centroids))
+            # Sum of members of each cluster, as sparse (clusters x rows) product
+            sums = coo_matrix((np.ones(n), (assignment, np.arange(n))), shape=(len(centroids), n)).dot(x)
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+        self.centroids = centroids
+        self.assignment = self._assign(x, centroids) if n > 0 else assignment
+        self._rebuild_lists()
+
+    def update(self, indices: np.ndarray, vectors: np.ndarray):
+        self.vectors[indices] = vectors
+        updated = self.vectors[indices]
+        max_norm = np.sqrt(np.max(np.sum(updated ** 2, axis=1))) if len(updated) > 0 else 0.0
+        if max_norm > self.max_norm:
+            # Reduction holds for any M not less than the maximal norm, so M only grows. Extra coordinate of every
+            # vector depends on M, so all vectors are re-augmented and reassigned to (unchanged) centroids.
+            self.max_norm = max_norm
+            self.assignment = self._assign(self._augment(self.vectors), self.centroids)
+        else:
+            self.assignment[indices] = self._assign(self._augment(updated), self.centroids)
+        self._rebuild_lists()
+
+    def search(self, query: np.ndarray, n: int, exclude: Optional[np.ndarray] = None) -> np.ndarray:
+        # Query gets 0 as extra coordinate, so only first part of centroid matters
+        centroid_scores = 2 * self.centroids[:, :-1].dot(query) - np.sum(self.centroids ** 2, axis=1)
+        list_rank = np.argsort(-centroid_scores)
+        order, indptr = self.lists
+        excluded = np.zeros(len(self.vectors), dtype=bool)
+        if exclude is not None:
+            excluded[exclude] = True
+
+        # Probing more lists if there are not enough candidates (e.g. user has seen most of probed items)
+        n_probe = self.n_probe
+        while True:
+            probed = list_rank[:n_probe]
+            candidates = np.concatenate([order[indptr[k]:indptr[k + 1]] for k in probed])
+            candidates = candidates[~excluded[candidates]]
+            if len(candidates) >= n or n_probe >= len(list_rank):
+                break
+            n_probe *= 2
+        scores = self.vectors[candidates].dot(query)
+        return candidates[top_n_indices(scores, n)]
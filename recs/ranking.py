@@ -0,0 +1,53 @@
+from typing import List
+
+import numpy as np
+
+
+def top_n_indices(scores: np.ndarray, n: int) -> np.ndarray:
+    """
+    Returns indices of n highest scores in decreasing order of score.
+    Uses argpartition, so only selected entries are sorted.
+    Entries set to -inf (e.g. already seen items) are never returned.
+    """
+    n = min(n, len(scores))
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if n < len(scores):
+        candidates = np.argpartition(-scores, n - 1)[:n]
+    else:
+        candidates = np.arange(len(scores))
+    candidates = candidates[np.argsort(-scores[candidates], kind="mergesort")]
+    return candidates[scores[candidates] > -np.inf]
+
+
+def top_n_indices_batch(scores: np.ndarray, n: int) -> List[np.ndarray]:
+    """
+    Row-wise top_n_indices for 2D score matrix
+    """
+    n = min(n, scores.shape[1])
+    if n <= 0:
+        return [np.zeros(0, dtype=np.int64) for _ in range(scores.shape[0])]
+    if n < scores.shape[1]:
+        candidates = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    else:
+        candidates = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    rows = np.arange(scores.shape[0])[:, None]
+    candidates = candidates[rows, np.argsort(-scores[rows, candidates], axis=1, kind="mergesort")]
+    selected = scores[rows, candidates] > -np.inf
+    return [c[s] for c, s in zip(candidates, selected)]
+
+
+def top_n_per_group(groups: np.ndarray, scores: np.ndarray, n: int) -> np.ndarray:
+    """
+    For entries split into groups (e.g. rows of sparse matrix), returns boolean mask of n highest scores in
+    each group. Ties are broken by position. Entries with -inf score are never selected.
+    """
+    order = np.lexsort((-scores, groups))
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]) if len(order) > 0 \
+        else np.zeros(0, dtype=np.int64)
+    # Rank of entry within its group
+    ranks = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    mask = np.zeros(len(order), dtype=bool)
+    mask[order[ranks < n]] = True
+    return mask & (scores > -np.inf)
@@ -1,26 +1,60 @@
-from typing import List, Dict
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from common import ItemRating
+import numpy as np
+
+from common import ItemRating, RatingColumns
+from common.snapshot import SnapshotError, read_snapshot, write_snapshot
+from .interaction_store import InteractionStore, HistoryView
 
 
 class RecommenderEngine:
+    # Should be incremented whenever engine's snapshot state changes its layout or meaning
+    SNAPSHOT_VERSION = 1
+    # Whether built engine keeps working in forked child processes (used for parallel evaluation)
+    FORK_SAFE = True
+
     def __init__(self):
-        # User and item lookups. Each entry is guaranteed to have at least 1 record
-        self.user_histories = dict()  # type: Dict[str, List[ItemRating]]
-        self.item_histories = dict()  # type: Dict[str, List[ItemRating]]
+        # All interactions are kept in columnar store; engines should prefer reading its arrays directly
+        self.interactions = InteractionStore()
+        # User and item lookups. Each entry is guaranteed to have at least 1 record.
+        # These are read-only views over interactions, kept for compatibility.
+        self.user_histories = HistoryView(self.interactions, by_user=True)  # type: Dict[str, List[ItemRating]]
+        self.item_histories = HistoryView(self.interactions, by_user=False)  # type: Dict[str, List[ItemRating]]
 
     def add_data(self, user_id: str, item_id: str, rating: float = 5.0, timestamp:int=0) -> None:
         """
         Indicates that userId is interested in itemId
         """
-        if user_id not in self.user_histories:
-            self.user_histories[user_id] = list()  # defaultdict has some quirks, and I do not like it
-        if item_id not in self.item_histories:
-            self.item_histories[item_id] = list()
-        rating_record = ItemRating(user_id, item_id, rating, timestamp)
-        # Adding same record to lookups for memory consumption reduction
-        self.item_histories[item_id].append(rating_record)
-        self.user_histories[user_id].append(rating_record)
+        self.interactions.append(user_id, item_id, rating, timestamp)
+
+    def add_data_columns(self, columns: RatingColumns) -> None:
+        """
+        Bulk version of add_data for a columnar chunk of records (see Loader.get_record_columns)
+        """
+        self.interactions.extend(columns.user_ids, columns.item_ids, columns.ratings, columns.timestamps)
+
+    @property
+    def watermark(self) -> Optional[int]:
+        """
+        Timestamp of the latest known record: incremental sync should request records from this point.
+        It is derived from interactions, so it is restored with snapshots too.
+        """
+        return self.interactions.max_timestamp()
+
+    def apply_deltas(self, records: Iterable[ItemRating]) -> int:
+        """
+        Ingests records from incremental sync (e.g. loader.get_records_since(engine.watermark)) with online updates.
+        Records that the engine already has are skipped, so overlapping or repeated deltas are safe.
+        Costs O(number of new records), not O(all records). Returns number of applied records.
+        """
+        applied = 0
+        for r in records:
+            if self.interactions.contains(r.user_id, r.item_id, r.rating, r.timestamp):
+                continue
+            self.add_data(r.user_id, r.item_id, r.rating, r.timestamp)
+            self.online_update_step(r.user_id, r.item_id)
+            applied += 1
+        return applied
 
     def online_update_step(self, user_id: str, item_id: str) -> None:
         """
@@ -41,8 +75,61 @@ class RecommenderEngine:
         """
         raise NotImplementedError()
 
+    def predict_ratings(self, user_ids: List[str], item_ids: List[str]) -> np.ndarray:
+        """
+        Predicts ratings for pairs (user_ids[i], item_ids[i]). Engines override it with vectorized versions.
+        """
+        return np.array([self.predict_rating(u, i) for u, i in zip(user_ids, item_ids)], dtype=np.float64)
+
     def build(self):
         """
         This is offline part of RS 
         """
         pass
+
+    def _get_model_state(self) -> Tuple[Dict[str, np.ndarray], dict]:
+        """
+        Returns arrays and JSON-serializable parameters of built model. Engines that do not override this
+        are rebuilt from restored interactions on load.
+        """
+        return {}, {}
+
+    def _set_model_state(self, arrays: Dict[str, np.ndarray], params: dict):
+        self.build()
+
+    def snapshot_state(self, copy: bool = False) -> Tuple[Dict[str, np.ndarray], dict]:
+        """
+        Returns arrays and metadata that save() writes. Arrays may be views of the engine's buffers; with <copy>
+        they are copied, so the state can be taken under a lock and written after it is released.
+        """
+        arrays, params = self._get_model_state()
+        state = {"interactions." + k: v for k, v in self.interactions.get_state().items()}
+        state.update({"model." + k: v for k, v in arrays.items()})
+        if copy:
+            state = {k: np.array(v) for k, v in state.items()}
+        return state, {
+            "engine": type(self).__name__,
+            "engine_version": self.SNAPSHOT_VERSION,
+            "params": params
+        }
+
+    def save(self, path: str):
+        """
+        Saves interactions and built model into memory-mappable snapshot file
+        """
+        write_snapshot(path, *self.snapshot_state())
+
+    def load(self, path: str, verify: bool = True):
+        """
+        Restores engine from snapshot made by save(). Arrays are memory-mapped, so startup does not depend on
+        data size, and processes mapping the same file share its pages.
+        Raises SnapshotError if snapshot is corrupted or was made by other engine or engine version.
+        """
+        state, meta = read_snapshot(path, verify)
+        if meta.get("engine") != type(self).__name__ or meta.get("engine_version") != self.SNAPSHOT_VERSION:
+            raise SnapshotError("Snapshot of %s v%s cannot be loaded into %s v%d" % (
+                meta.get("engine"), meta.get("engine_version"), type(self).__name__, self.SNAPSHOT_VERSION))
+        self.interactions.set_state({k[len("interactions."):]: v for k, v in state.items()
+                                     if k.startswith("interactions.")})
+        self._set_model_state({k[len("model."):]: v for k, v in state.items() if k.startswith("model.")},
+                              meta["params"])
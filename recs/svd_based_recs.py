@@ -1,81 +1,249 @@
-import typing
-
-from typing import Dict, List, Optional, Set
+from typing import Dict, List, Optional
 
+from common import avg_update
+from common.snapshot import SnapshotError
 from recs import RecommenderEngine
-from sparsesvd import sparsesvd
+from recs.matrix_builder import MatrixBuilder
+from recs.factorization import Factorization, SparseSVDFactorization
+from recs.mips_index import InnerProductIndex
+from recs.ranking import top_n_indices_batch
 import numpy as np
-from scipy.sparse import csc_matrix, dok_matrix
-from collections import Counter
+from scipy.sparse import csr_matrix
 
 
 class SVDBasedCF(RecommenderEngine):
-    def __init__(self, components: int = 40, include_avg_rating: bool = False):
+    SNAPSHOT_VERSION = 2
+
+    # Number of users scored at once in predict_interests_batch
+    BATCH_SIZE = 256
+
+    FOLD_IN_PROJECTION = "projection"
+    FOLD_IN_LEAST_SQUARES = "least_squares"
+
+    def __init__(self, components: int = 40, include_avg_rating: bool = False,
+                 item_index: Optional[InnerProductIndex] = None,
+                 factorization: Optional[Factorization] = None,
+                 fold_in: str = FOLD_IN_PROJECTION, update_item_averages: bool = False):
         super().__init__()
         self.components = components
+        # Truncated SVD backend; sparsesvd is used by default
+        self.factorization = factorization if factorization is not None else SparseSVDFactorization()
         self.global_average = 2.5
         self.include_avg_rating = include_avg_rating
+        # Optional index for sub-linear top-N retrieval. If None, all items are scored.
+        self.item_index = item_index
 
         self.user_vectors = dict()  # type: Dict[str, np.array]
         self.item_vectors = dict()  # type: Dict[str, np.array]
         self.item_average_rating = dict()  # type: Dict[str, float]
 
         # Stuff for online update step
-        self.rating_matrix_demeaned = None # type: Optional[dok_matrix]
+        self.fold_in = fold_in
+        # Updating item averages online is approximate: it shifts demeaned ratings of all users of the item
+        self.update_item_averages = update_item_averages
+        self.rating_matrix_demeaned = None # type: Optional[csr_matrix]
         self.col_vectors = None  # type: Optional[np.array]
         self.col_vectors_inv = None # type: Optional[np.array]
         self.user_row_index = dict()  # type: Dict[str, int]
         self.item_col_index = dict()  # type: Dict[str, int]
+        self.item_rating_count = np.zeros(0, dtype=np.int64)  # type: np.array
+        # Rows of users updated online since build (column -> demeaned rating)
+        self.folded_rows = dict()  # type: Dict[str, Dict[int, float]]
+        self.drift_updates = 0
+        self.drift_new_users = 0
+
+        # Item ids and average ratings by column
+        self.item_ids = np.zeros(0, dtype=object)  # type: np.array
+        self.item_bias = np.zeros(0)  # type: np.array
+
+    def _latest_rating(self, user_id: str, item_id: str) -> Optional[float]:
+        user_index = self.interactions.user_index.get(user_id)
+        item_index = self.interactions.item_index.get(item_id)
+        if user_index is None or item_index is None:
+            return None
+        positions = self.interactions.user_records(user_index)
+        positions = positions[self.interactions.items[positions] == item_index]
+        if len(positions) == 0:
+            return None
+        return float(self.interactions.ratings[positions[-1]])
+
+    def _user_row(self, user_id: str) -> Dict[int, float]:
+        """
+        Returns demeaned ratings of user (by column) that are reflected in user's current vector
+        """
+        if user_id not in self.folded_rows:
+            row = dict()  # type: Dict[int, float]
+            if user_id in self.user_row_index:
+                m = self.rating_matrix_demeaned
+                start, end = m.indptr[self.user_row_index[user_id]], m.indptr[self.user_row_index[user_id] + 1]
+                row = dict(zip(m.indices[start:end].tolist(), m.data[start:end].tolist()))
+            else:
+                self.drift_new_users += 1
+            self.folded_rows[user_id] = row
+        return self.folded_rows[user_id]
+
+    def _update_item_average(self, col: int, rating: float, old_rating: Optional[float]):
+        if old_rating is None:
+            self.item_rating_count[col] += 1
+            self.item_bias[col] = avg_update(self.item_bias[col], self.item_rating_count[col], rating)
+        else:
+            self.item_bias[col] += (rating - old_rating) / self.item_rating_count[col]
+        self.item_average_rating[self.item_ids[col]] = self.item_bias[col]
+        if self.include_avg_rating and self.item_index is not None:
+            self.item_index.update(np.array([col]), np.append(self.col_vectors[col], self.item_bias[col])[None, :])
 
     def online_update_step(self, user_id: str, item_id: str):
-        if self.col_vectors_inv is not None:
-            # Online update step. This is easily inferred from SVD formula.
-            # We cannot update average rating, however, as it invalidates all rows (i.e. we have to recompute SVD).
-            rating = self.global_average
-            for r in self.user_histories[user_id]:
-                if r.item_id == item_id:
-                    rating = r.rating
-            if item_id in self.item_col_index:
-                if user_id in self.user_row_index:
-                    row_index = self.user_row_index[user_id]
-                else:
-                    # This is efficient matrix because we keep demeaned rating in dok-matrix
-                    row_index = self.rating_matrix_demeaned.shape[0]
-                    self.rating_matrix_demeaned.resize((
-                        row_index + 1,
-                        self.rating_matrix_demeaned.shape[1]
-                    ))
-                    self.user_row_index[user_id] = row_index
-                self.rating_matrix_demeaned[row_index, self.item_col_index[item_id]] = rating - self.item_average_rating[item_id]
-                # what
-                self.user_vectors[user_id] = self.rating_matrix_demeaned[row_index].dot(self.col_vectors_inv)[0]
+        """
+        Folds the latest rating of the user into user's vector. Item vectors do not change, so item_index stays
+        consistent: it is queried with the new user vector.
+        This is easily inferred from SVD formula: A = U S V, so user vector is u = a V^T S^-1 = a col_vectors_inv,
+        where a is user's (demeaned) row. Single rating changes single entry of a, so u changes by
+        delta * col_vectors_inv[col] (FOLD_IN_PROJECTION). Alternatively, u can be fit by least squares on
+        factors of rated items only (FOLD_IN_LEAST_SQUARES).
+        New users are folded in the same way, starting with empty row.
+        """
+        if self.col_vectors_inv is None or item_id not in self.item_col_index:
+            # Items unknown to the model require rebuild
+            return
+        col = self.item_col_index[item_id]
+        rating = self._latest_rating(user_id, item_id)
+        if rating is None:
+            return
+        row = self._user_row(user_id)
+        old_value = row.get(col)
+        if self.update_item_averages:
+            old_rating = None if old_value is None else old_value + self.item_bias[col]
+            self._update_item_average(col, rating, old_rating)
+        value = rating - self.item_bias[col]
+        row[col] = value
+
+        if self.fold_in == self.FOLD_IN_LEAST_SQUARES:
+            cols = np.array(list(row.keys()))
+            vector = np.linalg.lstsq(self.col_vectors[cols], np.array(list(row.values())), rcond=None)[0]
+        else:
+            vector = self.user_vectors.get(user_id, np.zeros(self.col_vectors.shape[1]))
+            vector = vector + (value - (old_value or 0.0)) * self.col_vectors_inv[col]
+        # Replacing (not modifying) the vector, so concurrent readers never see partially updated one
+        self.user_vectors[user_id] = vector
+        self.drift_updates += 1
+
+    def drift(self) -> Dict[str, float]:
+        """
+        Summary of online updates since the last full build. Fraction of updated ratings is a reasonable signal
+        to schedule next rebuild.
+        """
+        return {
+            "updates": self.drift_updates,
+            "new_users": self.drift_new_users,
+            "updated_users": len(self.folded_rows),
+            "update_fraction": self.drift_updates / max(self.rating_matrix_demeaned.nnz, 1)
+            if self.rating_matrix_demeaned is not None else 0.0
+        }
 
     def build(self):
-        # Strictly speaking, enumeration order of Python dict's is not defined.
-        # In other words, iterating over same dict twice may yield different results. So, we have to keep mapping
-        # between user/item, and row/column.
-        self.user_row_index = dict()  # type: Dict[str, int]
-        self.item_col_index = dict()  # type: Dict[str, int]
-        self.rating_matrix_demeaned = dok_matrix((len(self.user_histories), len(self.item_histories)))
-
-        for col_index, (item_id, histories) in enumerate(self.item_histories.items()):
-            self.item_col_index[item_id] = col_index
-            avg_rating = np.mean([x.rating for x in histories])
-            self.item_average_rating[item_id] = avg_rating
-            for record in histories:
-                row_index = self.user_row_index.get(record.user_id, len(self.user_row_index))
-                self.user_row_index[record.user_id] = row_index
-                self.rating_matrix_demeaned[row_index, col_index] = record.rating - avg_rating
-        self.global_average = np.mean(list(self.item_average_rating.values()))
-        u, s, v = sparsesvd(csc_matrix(self.rating_matrix_demeaned), self.components)
+        # Rows and columns of the matrix are user and item indices of the interaction store
+        matrix = MatrixBuilder.from_interactions(self.interactions, MatrixBuilder.CORRECTION_ITEM_MEAN)
+        self.user_row_index = matrix.user_row_index
+        self.item_col_index = matrix.item_col_index
+        self.item_average_rating = matrix.item_avg_rating
+        self.global_average = np.mean(matrix.item_avg)
+        self.rating_matrix_demeaned = matrix.tocsr()
+        self.item_rating_count = np.diff(matrix.tocsc().indptr)
+        self.folded_rows = dict()
+        self.drift_updates = 0
+        self.drift_new_users = 0
+        u, s, v = self.factorization.factorize(matrix.tocsc(), self.components)
 
         row_vectors = u.T
         self.col_vectors = np.dot(np.diag(s), v).T
-        self.col_vectors_inv = np.linalg.pinv(self.col_vectors.transpose())
+        # Pseudo-inverse of (S V): rows of V are orthonormal, so it is V^T S^-1
+        self.col_vectors_inv = v.T / np.where(s > 0, s, np.inf)
         for u, row in self.user_row_index.items():
             self.user_vectors[u] = row_vectors[row]
-        for i, col in self.item_col_index.items():
-            self.item_vectors[i] = self.col_vectors[col]
+        # Column-aligned lookups for top-N scoring
+        self.item_ids = np.array(self.interactions.item_ids[:len(self.item_col_index)], dtype=object)
+        self.item_bias = matrix.item_avg
+        self._init_item_lookups()
+
+    def _init_item_lookups(self):
+        self.item_vectors = dict(zip(self.item_ids, self.col_vectors))
+        if self.item_index is not None:
+            self.item_index.build(self.index_vectors())
+
+    def _get_model_state(self):
+        if self.col_vectors is None:
+            return {}, {"components": self.components, "include_avg_rating": self.include_avg_rating}
+        user_ids = list(self.user_vectors.keys())
+        matrix = self.rating_matrix_demeaned
+        folded = [(u, c, v) for u, row in self.folded_rows.items() for c, v in row.items()]
+        folded_users = [u for u, row in self.folded_rows.items() if len(row) == 0]
+        arrays = {
+            "col_vectors": self.col_vectors,
+            "col_vectors_inv": self.col_vectors_inv,
+            "item_ids": np.array(self.item_ids.tolist(), dtype=str),
+            "item_bias": self.item_bias,
+            "user_ids": np.array(user_ids, dtype=str),
+            "user_vectors": np.array([self.user_vectors[u] for u in user_ids]).reshape(len(user_ids), -1),
+            "matrix_user_ids": np.array(sorted(self.user_row_index, key=self.user_row_index.get), dtype=str),
+            "matrix_indptr": matrix.indptr,
+            "matrix_indices": matrix.indices,
+            "matrix_data": matrix.data,
+            "item_rating_count": self.item_rating_count,
+            "folded_user_ids": np.array([x[0] for x in folded] + folded_users, dtype=str),
+            "folded_cols": np.array([x[1] for x in folded] + [-1] * len(folded_users), dtype=np.int64),
+            "folded_values": np.array([x[2] for x in folded] + [0.0] * len(folded_users)),
+        }
+        params = {
+            "components": self.components,
+            "include_avg_rating": self.include_avg_rating,
+            "global_average": float(self.global_average),
+            "drift_updates": self.drift_updates,
+            "drift_new_users": self.drift_new_users
+        }
+        return arrays, params
+
+    def _set_model_state(self, arrays, params):
+        if params["components"] != self.components or params["include_avg_rating"] != self.include_avg_rating:
+            raise SnapshotError("Snapshot was made with other SVDBasedCF parameters: %s" % params)
+        if "col_vectors" not in arrays:
+            return
+        self.global_average = params["global_average"]
+        self.col_vectors = arrays["col_vectors"]
+        self.col_vectors_inv = arrays["col_vectors_inv"]
+        self.item_ids = arrays["item_ids"].astype(object)
+        # Copying arrays that online update step modifies; mapped ones are read-only
+        self.item_bias = np.array(arrays["item_bias"])
+        self.item_rating_count = np.array(arrays["item_rating_count"])
+        self.item_col_index = {x: i for i, x in enumerate(self.item_ids)}
+        self.item_average_rating = dict(zip(self.item_ids, self.item_bias))
+        self.user_vectors = dict(zip(arrays["user_ids"].tolist(), arrays["user_vectors"]))
+        matrix_user_ids = arrays["matrix_user_ids"].tolist()
+        self.user_row_index = {x: i for i, x in enumerate(matrix_user_ids)}
+        self.rating_matrix_demeaned = csr_matrix(
+            (arrays["matrix_data"], arrays["matrix_indices"], arrays["matrix_indptr"]),
+            shape=(len(matrix_user_ids), len(self.item_ids))
+        )
+        self.folded_rows = dict()
+        for user_id, col, value in zip(arrays["folded_user_ids"].tolist(), arrays["folded_cols"].tolist(),
+                                       arrays["folded_values"].tolist()):
+            row = self.folded_rows.setdefault(user_id, dict())
+            if col >= 0:
+                row[col] = value
+        self.drift_updates = params["drift_updates"]
+        self.drift_new_users = params["drift_new_users"]
+        self._init_item_lookups()
+
+    def index_vectors(self) -> np.ndarray:
+        # Item bias is folded into inner product as extra coordinate (user side gets 1.0)
+        if self.include_avg_rating:
+            return np.hstack([self.col_vectors, self.item_bias[:, None]])
+        return self.col_vectors
+
+    def index_query(self, user_id: str) -> np.ndarray:
+        user_vector = self.user_vectors.get(user_id, np.zeros(self.col_vectors.shape[1]))
+        if self.include_avg_rating:
+            return np.append(user_vector, 1.0)
+        return user_vector
 
     def predict_rating(self, user_id: str, item_id: str):
         pers_rating = 0.0
@@ -83,18 +251,51 @@ class SVDBasedCF(RecommenderEngine):
             pers_rating = np.dot(self.user_vectors[user_id], self.item_vectors[item_id])
         return pers_rating + self.item_average_rating.get(item_id, self.global_average)
 
+    def predict_ratings(self, user_ids: List[str], item_ids: List[str]) -> np.ndarray:
+        cols = np.array([self.item_col_index.get(x, -1) for x in item_ids], dtype=np.int64)
+        has_item = cols >= 0
+        ratings = np.full(len(cols), float(self.global_average))
+        ratings[has_item] = self.item_bias[cols[has_item]]
+        vectors = [self.user_vectors.get(x) for x in user_ids]
+        known = has_item & np.array([x is not None for x in vectors], dtype=bool)
+        if np.any(known):
+            user_matrix = np.array([x for x, k in zip(vectors, known) if k])
+            # Row-wise dot products of user and item vectors
+            ratings[known] += np.einsum("ij,ij->i", user_matrix, self.col_vectors[cols[known]])
+        return ratings
+
+    def _seen_columns(self, user_id: str) -> np.ndarray:
+        user_index = self.interactions.user_index.get(user_id)
+        if user_index is None:
+            return np.zeros(0, dtype=np.int64)
+        # Columns are item indices of the interaction store; items added after build have no column
+        cols = self.interactions.items[self.interactions.user_records(user_index)]
+        return cols[cols < len(self.item_ids)]
+
     def predict_interests(self, user_id: str, n: int = 5):
+        if self.item_index is not None and self.col_vectors is not None:
+            top = self.item_index.search(self.index_query(user_id), n, exclude=self._seen_columns(user_id))
+            return self.item_ids[top].tolist()
+        return self.predict_interests_batch([user_id], n)[0]
+
+    def predict_interests_batch(self, user_ids: List[str], n: int = 5) -> List[List[str]]:
+        """
+        Scores several users with single matrix multiplication (in chunks of BATCH_SIZE users)
+        """
         if self.col_vectors is None:
-            return []
-        affinities = np.dot(self.col_vectors, self.user_vectors.get(user_id, np.zeros(self.components)))
-        predicted_ratings = Counter()  # type: typing.Counter[str]
-        if self.include_avg_rating:
-            for item_id, col in self.item_col_index.items():
-                predicted_ratings[item_id] = affinities[col] + self.item_average_rating[item_id]
-        else:
-            for item_id, col in self.item_col_index.items():
-                predicted_ratings[item_id] = affinities[col]
-        # Excluding seen items
-        for record in self.user_histories.get(user_id, []):
-            predicted_ratings.pop(record.item_id, None)
-        return [x for x, _ in predicted_ratings.most_common(n)]
+            return [[] for _ in user_ids]
+        if self.item_index is not None:
+            return [self.predict_interests(u, n) for u in user_ids]
+        zeros = np.zeros(self.col_vectors.shape[1])
+        result = []  # type: List[List[str]]
+        for start in range(0, len(user_ids), self.BATCH_SIZE):
+            batch = user_ids[start:start + self.BATCH_SIZE]
+            affinities = np.dot(np.array([self.user_vectors.get(u, zeros) for u in batch]), self.col_vectors.T)
+            if self.include_avg_rating:
+                affinities += self.item_bias
+            # Excluding seen items
+            for row, user_id in enumerate(batch):
+                affinities[row, self._seen_columns(user_id)] = -np.inf
+            for top in top_n_indices_batch(affinities, n):
+                result.append(self.item_ids[top].tolist())
+        return result
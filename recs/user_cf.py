@@ -1,10 +1,11 @@
-from typing import Set, Dict
-from collections import Counter
-from scipy.spatial.distance import cosine
+from typing import List, Optional, Tuple
 
 from recs import RecommenderEngine
-from recs.matrix_builder import MatrixBuilder
+from recs.matrix_builder import MatrixBuilder, compressed_entries
+from recs.ranking import top_n_indices_batch, top_n_per_group
 import numpy as np
+from scipy.sparse import csr_matrix, csc_matrix
+
 
 class UserBasedNNCF(RecommenderEngine):
     """
@@ -13,95 +14,198 @@ class UserBasedNNCF(RecommenderEngine):
     neighbourhood to estimate ratings and make predictions.
 
     Parameter <neighbour_size> is used to control how many users are included in neighbourhood.
+    Candidates are raters of the item; only <neighbour_sample_max_size> of them with most co-rated items are
+    considered.
 
     Usually we use Pearson correlation between user ratings (taking into account only co-rated items). However, we
     might want to subtract user or item averages to remove the bias, as describer in
     {Yao, G. (n.d.). User-Based and Item-Based Collaborative Filtering Recommendation Algorithms Design.}.
-    Parameter correction_mode controls this behaviour.
+    Parameter correction_mode controls this behaviour. Cosine similarity (of co-rated items) can be used instead.
 
     After calculating neighbourhood we have to estimate ratings. We can do this by calculating weighted average of ratings (see
     {Sarwar, B., Karypis, G., Konstan, J., & Reidl, J. (2001). Item-based collaborative filtering recommendation algorithms. Proceedings of the Tenth International Conference on World Wide Web  - WWW ’01, 285–295. https://doi.org/10.1145/371920.372071}
     ) or, again, we can subtract users' ratings averages before that procedure,  as described in
     {Resnick, P., Iacovou, N., Suchak, M., Bergstrom, P., & Riedl, J. (1994). GroupLens : An Open Architecture for Collaborative Filtering of Netnews. Proceedings of the 1994 ACM Conference on Computer Supported Cooperative Work, 175–186. https://doi.org/10.1145/192844.192905}
-    This is controlled by prediction_mode parameter.
+    This is controlled by prediction_mode parameter. Neighbours are candidates with the highest similarity, so
+    negatively correlated ones are used too (with negative weight) when there are not enough positive ones;
+    candidates with zero similarity (e.g. too few co-rated items) are not.
+
+    All sums over co-rated items are sparse matrix products: with binary matrix B of rated entries and matrix X of
+    (corrected) ratings, co-rating counts are B B^T, sums of products are X X^T, sums of a's ratings over items
+    co-rated with b are X B^T, and so on.
+    With <neighbour_table_size> > 0, top neighbours (by similarity) of every user are computed in build(), and
+    prediction uses only those of them who rated the item.
     """
-    CORRECTION_NONE = "none"
-    CORRECTION_USER_MEAN = "user_mean"
-    CORRECTION_ITEM_MEAN = "item_mean"
+    CORRECTION_NONE = MatrixBuilder.CORRECTION_NONE
+    CORRECTION_USER_MEAN = MatrixBuilder.CORRECTION_USER_MEAN
+    CORRECTION_ITEM_MEAN = MatrixBuilder.CORRECTION_ITEM_MEAN
 
     PREDICTION_AVERAGE = "avg"
     PREDICTION_UNBIASED_AVERAGE = "unbiased_avg"
 
+    SIMILARITY_PEARSON = "pearson"
+    SIMILARITY_COSINE = "cosine"
+
+    # Similarity of users with fewer co-rated items is zero
+    MIN_CORATED_ITEMS = 2
+    # Size (number of entries) of dense similarity blocks computed in build()
+    BLOCK_SIZE = 2 ** 22
+
     def __init__(self, neighbour_size: int = 5,
                  correction_mode: str = CORRECTION_NONE,
                  prediction_mode: str = PREDICTION_AVERAGE,
-                 neighbour_sample_max_size: int = 20):
+                 neighbour_sample_max_size: int = 20,
+                 similarity: str = SIMILARITY_PEARSON,
+                 neighbour_table_size: int = 0):
         self.correction_mode = correction_mode
         self.neighbour_size = neighbour_size
         self.prediction_mode = prediction_mode
         self.neighbour_sample_max_size = neighbour_sample_max_size
+        self.similarity = similarity
+        self.neighbour_table_size = neighbour_table_size
         self.rating_matrix = None  # type: MatrixBuilder
+        # Rows are users, columns are items (indices of interaction store)
+        self.ratings = None  # type: Optional[csc_matrix]
+        # Binary matrix of rated entries, (corrected) ratings and their squares
+        self.rated = None  # type: Optional[csr_matrix]
+        self.values = None  # type: Optional[csr_matrix]
+        self.values_squared = None  # type: Optional[csr_matrix]
+        # Same matrices transposed (rows are items), so products with them are CSR by CSR
+        self.rated_t = None  # type: Optional[csr_matrix]
+        self.values_t = None  # type: Optional[csr_matrix]
+        self.values_squared_t = None  # type: Optional[csr_matrix]
+        # Neighbour rows (columns) and similarities (data) of each user row
+        self.neighbours = None  # type: Optional[csr_matrix]
+        self.global_average = 2.5
         super().__init__()
 
     def build(self):
-        self.rating_matrix = MatrixBuilder(self.user_histories, self.item_histories)
-
-        print("Matrix built")
-        self._user_lookup = {k: set([x.item_id for x in v]) for k, v in self.user_histories.items()}
-        self._item_lookup = {k: set([x.user_id for x in v]) for k, v in self.item_histories.items()}
-        print("Lookups built")
-        if self.correction_mode == self.CORRECTION_ITEM_MEAN:
-            for u, history in self.user_histories.items():
-                for r in history:
-                    self.rating_matrix.m[self.rating_matrix.user_row_index[u], self.rating_matrix.item_col_index[r.item_id]] -= \
-                        self.rating_matrix.item_avg_rating[r.item_id]
-        elif self.correction_mode == self.CORRECTION_USER_MEAN:
-            for u, history in self.user_histories.items():
-                for r in history:
-                    self.rating_matrix.m[self.rating_matrix.user_row_index[u], self.rating_matrix.item_col_index[r.item_id]] -= \
-                        self.rating_matrix.user_avg_rating[u]
-        print("Subtracted bias")
-
-
-    def _get_similar_user_candidates(self, user_id: str, item_id: str, cap: int) -> Set[str]:
-        if item_id not in self._item_lookup:
-            return set()
-        cands = Counter()
-        user_items = self._user_lookup[user_id]
-        for u in self._item_lookup[item_id]:
-            l = len(self._user_lookup[u] & user_items)
-            if l > 0:
-                cands[u] = l
-        cands.pop(user_id, None)
-        return set([x for x, _ in cands.most_common(cap)])
-
-    def _get_similarity(self, user_a: str, user_b: str) -> float:
-        return 1.0
-        corated_items = self._user_lookup[user_a] & self._user_lookup[user_b]
-        corated_items_indices = [self.rating_matrix.item_col_index[x] for x in corated_items]
-        v_a = self.rating_matrix.m[self.rating_matrix.user_row_index[user_a], corated_items_indices].todense()
-        v_b = self.rating_matrix.m[self.rating_matrix.user_row_index[user_b], corated_items_indices].todense()
-        cos = cosine(v_a, v_b)
-        if np.isnan(cos):
-            return 0.0
+        if self.similarity not in (self.SIMILARITY_PEARSON, self.SIMILARITY_COSINE):
+            raise ValueError("Unknown similarity %s" % self.similarity)
+        self.rating_matrix = MatrixBuilder.from_interactions(self.interactions, self.correction_mode)
+        values = self.rating_matrix.tocsr()
+        shape = values.shape
+        # Restoring raw ratings from corrected ones
+        if self.correction_mode == self.CORRECTION_USER_MEAN:
+            offsets = np.repeat(self.rating_matrix.user_avg, np.diff(values.indptr))
+        elif self.correction_mode == self.CORRECTION_ITEM_MEAN:
+            offsets = self.rating_matrix.item_avg[values.indices]
         else:
-            return cos
+            offsets = 0.0
+        self.rated = csr_matrix((np.ones(values.nnz), values.indices, values.indptr), shape=shape)
+        self.values = values
+        self.values_squared = csr_matrix((values.data ** 2, values.indices, values.indptr), shape=shape)
+        self.rated_t = self.rated.T.tocsr()
+        self.values_t = self.values.T.tocsr()
+        self.values_squared_t = self.values_squared.T.tocsr()
+        self.ratings = csr_matrix((values.data + offsets, values.indices, values.indptr), shape=shape).tocsc()
+        self.global_average = float(np.mean(self.ratings.data)) if values.nnz > 0 else 2.5
+        print("Matrix built")
 
-    def predict_rating(self, user_id: str, item_id: str):
-        cand_sims = Counter()
-        cands = self._get_similar_user_candidates(user_id, item_id, self.neighbour_sample_max_size) & self._item_lookup.get(item_id, set())
+        self.neighbours = None
+        if self.neighbour_table_size > 0:
+            self.neighbours = self._build_neighbour_table()
+            print("Neighbour table built")
+
+    def _similarities(self, rows: np.ndarray, candidates: Optional[np.ndarray] = None) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns dense matrices of co-rating counts and similarities between users of <rows> and <candidates>
+        (all users if None)
+        """
+        def products(a: csr_matrix, b_t: csr_matrix) -> np.ndarray:
+            result = a[rows].dot(b_t).toarray()
+            return result if candidates is None else result[:, candidates]
 
-        for cand in cands:
-            cand_sims[cand] = self._get_similarity(user_id, cand)
-        if len(cand_sims) == 0:
-            return self.rating_matrix.user_avg_rating[user_id]
+        counts = products(self.rated, self.rated_t)
+        xy = products(self.values, self.values_t)
+        xx = products(self.values_squared, self.rated_t)
+        yy = products(self.rated, self.values_squared_t)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if self.similarity == self.SIMILARITY_PEARSON:
+                x = products(self.values, self.rated_t)
+                y = products(self.rated, self.values_t)
+                xy = xy - x * y / counts
+                xx = xx - x * x / counts
+                yy = yy - y * y / counts
+            norm = np.sqrt(np.maximum(xx, 0.0) * np.maximum(yy, 0.0))
+            similarities = np.where((norm > 1e-9) & (counts >= self.MIN_CORATED_ITEMS), xy / norm, 0.0)
+        return counts, similarities
 
-        best_candidates = dict(cand_sims.most_common(self.neighbour_size))  # type: Dict[str, float]
+    def _build_neighbour_table(self) -> csr_matrix:
+        n_users = self.ratings.shape[0]
+        block = max(1, self.BLOCK_SIZE // max(n_users, 1))
+        indices = []  # type: List[np.ndarray]
+        data = []  # type: List[np.ndarray]
+        for start in range(0, n_users, block):
+            rows = np.arange(start, min(start + block, n_users))
+            _, similarities = self._similarities(rows)
+            similarities[similarities == 0] = -np.inf
+            similarities[np.arange(len(rows)), rows] = -np.inf
+            for row, top in zip(similarities, top_n_indices_batch(similarities, self.neighbour_table_size)):
+                indices.append(top)
+                data.append(row[top])
+        indptr = np.r_[0, np.cumsum([len(x) for x in indices])]
+        return csr_matrix((np.concatenate(data + [np.zeros(0)]),
+                           np.concatenate(indices + [np.zeros(0, dtype=np.int64)]), indptr),
+                          shape=(n_users, n_users))
+
+    def _predict_for_user(self, row: int, cols: np.ndarray) -> np.ndarray:
+        """
+        Predicts ratings of user <row> for item columns <cols>
+        """
+        positions, segments = compressed_entries(self.ratings.indptr, cols)
+        raters = self.ratings.indices[positions]
+        keep = raters != row
+        positions, segments, raters = positions[keep], segments[keep], raters[keep]
+
+        if self.neighbours is not None:
+            # Similarities of raters that are in user's neighbour table (they are non-zero), zero for others
+            weights = self.neighbours[row].toarray()[0, raters]
+        else:
+            candidates = np.unique(raters)
+            counts, similarities = self._similarities(np.array([row]), candidates)
+            found = np.searchsorted(candidates, raters)
+            # Sample of candidates with most co-rated items, for every item
+            counts = counts[0, found].astype(np.float64)
+            sample = top_n_per_group(segments, np.where(counts > 0, counts, -np.inf), self.neighbour_sample_max_size)
+            weights = np.where(sample, similarities[0, found], 0.0)
+
+        selected = top_n_per_group(segments, np.where(weights != 0, weights, -np.inf), self.neighbour_size)
+        segments, weights, positions = segments[selected], weights[selected], positions[selected]
+        ratings = self.ratings.data[positions]
         if self.prediction_mode == self.PREDICTION_AVERAGE:
-            acc = 0.0
-            for c, w in best_candidates.items():
-                acc += w * (self.rating_matrix.get_rating(c, item_id) - self.rating_matrix.user_avg_rating[c])
-            return acc / (sum(np.abs([x for _, x in best_candidates.items()])) + 1e-7) + self.rating_matrix.user_avg_rating[user_id]
+            ratings = ratings - self.rating_matrix.user_avg[self.ratings.indices[positions]]
+        totals = np.bincount(segments, weights=weights * ratings, minlength=len(cols))
+        norms = np.bincount(segments, weights=np.abs(weights), minlength=len(cols))
+        user_average = self.rating_matrix.user_avg[row]
+        if self.prediction_mode == self.PREDICTION_AVERAGE:
+            predictions = totals / (norms + 1e-7) + user_average
         else:
-            acc = np.sum([w * self.rating_matrix.get_rating(c, item_id) for c, w in best_candidates.items()])
-            return acc / (sum(np.abs([x for _, x in best_candidates.items()])) + 1e-7)
+            predictions = totals / (norms + 1e-7)
+        # Without neighbours user's average rating is used
+        return np.where(norms > 0, predictions, user_average)
+
+    def predict_rating(self, user_id: str, item_id: str):
+        return float(self.predict_ratings([user_id], [item_id])[0])
+
+    def predict_ratings(self, user_ids: List[str], item_ids: List[str]) -> np.ndarray:
+        """
+        Pairs are grouped by user, so similarities of each user are computed once per call
+        """
+        rows = np.array([self.rating_matrix.user_row_index.get(x, -1) for x in user_ids], dtype=np.int64)
+        cols = np.array([self.rating_matrix.item_col_index.get(x, -1) for x in item_ids], dtype=np.int64)
+        # Unknown users get item average rating, or global average for unknown items
+        item_avg = np.append(self.rating_matrix.item_avg, self.global_average)
+        predictions = item_avg[np.where(cols >= 0, cols, len(item_avg) - 1)]
+        known_users = rows >= 0
+        if not np.any(known_users):
+            return predictions
+        predictions[known_users] = self.rating_matrix.user_avg[rows[known_users]]
+        known = np.flatnonzero(known_users & (cols >= 0))
+        order = known[np.argsort(rows[known], kind="mergesort")]
+        boundaries = np.flatnonzero(np.diff(rows[order])) + 1
+        for group in np.split(order, boundaries):
+            if len(group) > 0:
+                predictions[group] = self._predict_for_user(rows[group[0]], cols[group])
+        return predictions
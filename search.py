@@ -0,0 +1,151 @@
+import hashlib
+import json
+import multiprocessing
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from evaluator import TimeBasedEvaluator
+from recs import RecommenderEngine
+
+# Search of running sweep; forked workers inherit it instead of pickling engines, factories and scorers
+_shared_search = None  # type: Optional[HyperparameterSearch]
+
+
+def _init_worker(slots, threads_per_job: int):
+    # Each worker is pinned to its own CPUs, so parallel jobs (and their BLAS threads) do not compete for cores
+    with slots.get_lock():
+        slot = slots.value
+        slots.value += 1
+    if hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        start = slot * threads_per_job % len(cpus)
+        os.sched_setaffinity(0, cpus[start:start + threads_per_job] or cpus)
+    # Pool workers cannot fork their own pools
+    _shared_search.evaluator.n_jobs = 1
+
+
+def _run_job(job: Tuple[Any, Optional[float]]) -> Tuple[Any, Optional[float], List[float]]:
+    params, budget = job
+    return params, budget, _shared_search.evaluate(params, budget)
+
+
+class HyperparameterSearch:
+    """
+    Evaluates engines with different parameters on the same partitions of TimeBasedEvaluator.
+    Train partitions are fed once into shared interaction store; engine for each grid point gets a copy of it
+    (instead of re-feeding records) and is only built. Grid points are evaluated by a pool of <n_jobs> forked
+    processes, each pinned to <threads_per_job> CPUs.
+
+    Scores are appended to <cache_path> (JSON lines, keyed by search name, parameters and budget) as soon as they are
+    ready, so interrupted sweep resumes from where it stopped. Keys also include fingerprint of train and test
+    records and names of scorers, so results computed on other data or with other metrics are not reused; changes
+    of engine code are not detected, so the cache should be removed after them.
+
+    <engine_factory> gets parameters and budget (e.g. number of epochs; None if search runs without budgets).
+    """
+    def __init__(self, name: str, evaluator: TimeBasedEvaluator,
+                 engine_factory: Callable[[Any, Optional[float]], RecommenderEngine], scorers: List[Callable],
+                 train_partitions: List[str] = ["train"], test_partitions: List[str] = ["valid"],
+                 cache_path: Optional[str] = None, n_jobs: int = 1, threads_per_job: int = 1):
+        self.name = name
+        self.evaluator = evaluator
+        self.engine_factory = engine_factory
+        self.scorers = scorers
+        self.test_partitions = test_partitions
+        self.cache_path = cache_path
+        self.n_jobs = n_jobs
+        self.threads_per_job = threads_per_job
+        self.train = RecommenderEngine()
+        for p in train_partitions:
+            evaluator._feed_partition(self.train, p)
+        self.fingerprint = self._fingerprint(train_partitions)
+        self.results = self._read_cache()  # type: Dict[str, List[float]]
+
+    def _fingerprint(self, train_partitions: List[str]) -> str:
+        h = hashlib.sha1(json.dumps([train_partitions, self.test_partitions,
+                                     [getattr(x, "__name__", repr(x)) for x in self.scorers]]).encode())
+        for p in list(train_partitions) + list(self.test_partitions):
+            columns = self.evaluator.partition_columns(p)
+            for array in [columns.user_ids, columns.item_ids, columns.ratings, columns.timestamps]:
+                h.update(np.ascontiguousarray(array).data)
+        return h.hexdigest()
+
+    def _key(self, params: Any, budget: Optional[float]) -> str:
+        return json.dumps([self.name, self.fingerprint, params, budget], sort_keys=True)
+
+    def _read_cache(self) -> Dict[str, List[float]]:
+        results = dict()
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return results
+        with open(self.cache_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Line could be cut by interruption
+                    continue
+                results[entry["key"]] = entry["scores"]
+        return results
+
+    def _store(self, params: Any, budget: Optional[float], scores: List[float]):
+        key = self._key(params, budget)
+        self.results[key] = scores
+        if self.cache_path is not None:
+            with open(self.cache_path, "a") as f:
+                f.write(json.dumps({"key": key, "scores": scores}) + "\n")
+
+    def make_engine(self, params: Any, budget: Optional[float] = None) -> RecommenderEngine:
+        """
+        Returns engine for given parameters with train data loaded (but not built)
+        """
+        engine = self.engine_factory(params, budget)
+        engine.interactions.load_from(self.train.interactions)
+        return engine
+
+    def evaluate(self, params: Any, budget: Optional[float] = None) -> List[float]:
+        engine = self.make_engine(params, budget)
+        engine.build()
+        scores = []
+        for p in self.test_partitions:
+            scores.extend(self.evaluator._evaluate_scoring_on_partition(engine, p, self.scorers))
+        return np.mean(np.array(scores), axis=0).tolist()
+
+    def _evaluate_all(self, grid: List[Any], budget: Optional[float]) -> List[List[float]]:
+        global _shared_search
+        jobs = [(params, budget) for params in grid if self._key(params, budget) not in self.results]
+        if self.n_jobs > 1 and len(jobs) > 1:
+            context = multiprocessing.get_context("fork")
+            _shared_search = self
+            try:
+                with context.Pool(self.n_jobs, _init_worker, (context.Value("i", 0), self.threads_per_job)) as pool:
+                    for params, budget, scores in pool.imap_unordered(_run_job, jobs):
+                        self._store(params, budget, scores)
+                        print("%s %s (budget %s): %s" % (self.name, params, budget, scores))
+            finally:
+                _shared_search = None
+        else:
+            for params, budget in jobs:
+                scores = self.evaluate(params, budget)
+                self._store(params, budget, scores)
+                print("%s %s (budget %s): %s" % (self.name, params, budget, scores))
+        return [self.results[self._key(params, budget)] for params in grid]
+
+    def run(self, grid: List[Any], budgets: Optional[List[float]] = None,
+            eta: int = 3) -> List[Tuple[Any, List[float]]]:
+        """
+        Without budgets every grid point is evaluated. With (increasing) budgets, successive halving is used:
+        all points are evaluated with the first budget, best 1/eta of them with the next one, and so on.
+        Returns (parameters, scores) of points that reached the last round, best (lowest first score) first.
+        """
+        candidates = list(grid)
+        rounds = budgets if budgets is not None else [None]
+        for i, budget in enumerate(rounds):
+            scores = self._evaluate_all(candidates, budget)
+            # Stable sort: ties keep grid order, so results do not depend on completion order of jobs
+            ranking = sorted(range(len(candidates)), key=lambda x: scores[x][0])
+            results = [(candidates[x], scores[x]) for x in ranking]
+            if i + 1 < len(rounds):
+                candidates = [x[0] for x in results[:max(1, len(results) // eta)]]
+        return results
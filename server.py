@@ -1,18 +1,27 @@
 import argparse
 import logging
+import multiprocessing
+import os
 
 import time
 from flask import Flask, request, jsonify
+
+from common.snapshot import SnapshotError
 from loader import MovieLensLoader, PostgresLoader
 from recs import SVDBasedCF, UserBasedNNCF
+from serving import ModelHolder, RebuildScheduler, RatingWriter, DeltaSync, SnapshotFollower, SnapshotPublisher, \
+    serve_workers, wait_workers
 
 app = Flask(__name__)
+# Keeping order of keys, e.g. search results are ranked
+app.config["JSON_SORT_KEYS"] = False
 
 
 @app.route("/rest/<user_id>/recommend", methods=['GET', 'POST'])
 def recommend(user_id):
-    interests = rs.predict_interests(user_id)
-    predicted_interpretation = [(x, ldr.get_item_description(x)) for x in interests]
+    interests = holder.engine.predict_interests(user_id)
+    descriptions = ldr.get_item_descriptions(interests)
+    predicted_interpretation = [(x, descriptions[x]) for x in interests]
     response = {
         "recommendations": predicted_interpretation,
     }
@@ -21,8 +30,9 @@ def recommend(user_id):
 
 @app.route("/rest/<user_id>/history", methods=['GET', 'POST'])
 def show_history(user_id):
-    historical_records = [ldr.get_item_description(x.item_id) + " rated with " + str(x.rating)
-                          for x in rs.user_histories.get(user_id, [])]
+    history = holder.engine.user_histories.get(user_id, [])
+    descriptions = ldr.get_item_descriptions([x.item_id for x in history])
+    historical_records = [descriptions[x.item_id] + " rated with " + str(x.rating) for x in history]
     response = {
         "history": historical_records,
     }
@@ -33,9 +43,13 @@ def show_history(user_id):
 def rate(user_id, item_id):
     try:
         rating = float(request.args.get("rating", "5.0"))
-        ldr.put_record(item_id, user_id, rating, int(time.time()))
-        rs.add_data(user_id, item_id, rating=rating)
-        rs.online_update_step(user_id, item_id)
+        PostgresLoader.validate_record(item_id, user_id, rating)
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    try:
+        # Rating is applied by the single writer; the handler does not wait for it. So "ok" means that the rating
+        # is accepted, not that it is stored: with several workers, others see it after the next publish.
+        writer.submit(user_id, item_id, rating, int(time.time()))
         return jsonify({'ok': True})
     except Exception as e:
         logging.exception("Exception during rating")
@@ -45,32 +59,117 @@ def rate(user_id, item_id):
 @app.route("/rest/find_item/", methods=['POST', 'GET'])
 def find_item():
     try:
-        tokens = set(request.args.get("query", "").lower().split())
+        rs = holder.engine
         found = {}
-        for item_id, item in ldr.get_items():
-            if len(set(item.name.lower().split()) & tokens) == len(tokens):
-                found[item_id] = str(item) + "(" + str(len(rs.item_histories.get(item_id, set()))) + " raters)"
-                if len(found) > 30:
-                    break
+        for item_id, item in ldr.get_search_index().search(request.args.get("query", ""), 30,
+                                                            rs.interactions.item_count):
+            found[item_id] = str(item) + "(" + str(rs.interactions.item_count(item_id)) + " raters)"
         return jsonify(found)
     except Exception as e:
         logging.exception("Exception during search")
         return jsonify({'ok': False, 'error': str(e)}), 400
 
 
+@app.route("/rest/stats", methods=['GET'])
+def stats():
+    if scheduler is not None:
+        return jsonify(scheduler.metrics())
+    return jsonify(holder.staleness())
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Movie recommender engine')
     parser.add_argument("--port", default=80, help="Port for server")
+    parser.add_argument("--snapshot", default=None,
+                        help="Model snapshot file. It is loaded if exists, otherwise it is created after build")
+    parser.add_argument("--rebuild_interval", type=float, default=None,
+                        help="Rebuild model in background every N seconds")
+    parser.add_argument("--rebuild_after", type=int, default=None,
+                        help="Rebuild model in background after N new ratings")
+    parser.add_argument("--rebuild_mode", default=RebuildScheduler.MODE_THREAD,
+                        choices=[RebuildScheduler.MODE_THREAD, RebuildScheduler.MODE_PROCESS],
+                        help="Build model on a thread, or in a forked process. Forking a process that runs threads "
+                             "may deadlock the build (see RebuildScheduler), so thread is the default")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes. With several workers --snapshot is required: workers map "
+                             "it read-only, and the master applies ratings and republishes it. So a worker sees "
+                             "ratings received by others (and rebuilt models) up to --publish_interval seconds "
+                             "(plus the time of writing the snapshot) later")
+    parser.add_argument("--sync_interval", type=float, default=None,
+                        help="Pull ratings written to the database by other instances every N seconds")
+    parser.add_argument("--publish_interval", type=float, default=60.0,
+                        help="How often (in seconds) updated model is published to workers")
     (args) = parser.parse_args()
+    if args.workers > 1 and args.snapshot is None:
+        parser.error("--workers requires --snapshot")
     print("Starting up")
     # Populating recommender system with data
     ldr = PostgresLoader("postgres", "postgres", "rs_pg", 5432, "mydb")
     rs = SVDBasedCF(70)
 
-    for r in ldr.get_records():
-        rs.add_data(r.user_id, r.item_id, r.rating, r.timestamp)
-    rs.build()
+    loaded = False
+    if args.snapshot is not None and os.path.exists(args.snapshot):
+        try:
+            rs.load(args.snapshot)
+            loaded = True
+            print("Loaded snapshot %s" % args.snapshot)
+        except SnapshotError:
+            logging.exception("Snapshot is rejected, rebuilding")
+            rs = SVDBasedCF(70)
+    if not loaded:
+        # Ratings are streamed in columnar chunks, so no per-record objects are created
+        for chunk in ldr.get_record_columns():
+            rs.add_data_columns(chunk)
+        rs.build()
+        if args.snapshot is not None:
+            rs.save(args.snapshot)
 
     print("RS knows %d users and %d items" % (len(rs.user_histories), len(rs.item_histories)))
 
-    app.run("0.0.0.0", port=args.port)
+    holder = ModelHolder(rs)
+    if loaded:
+        # Snapshot may be older than the database: ratings written after it was saved (its watermark is restored
+        # with interactions) are applied once before serving, whether or not periodic sync is enabled
+        print("Applied %d ratings written after the snapshot" % DeltaSync(holder, ldr).sync())
+    scheduler = None
+    if args.rebuild_interval is not None or args.rebuild_after is not None:
+        scheduler = RebuildScheduler(holder, lambda: SVDBasedCF(70), args.rebuild_interval, args.rebuild_after,
+                                     args.rebuild_mode)
+
+    if args.workers > 1:
+        # Workers only read the model. Ratings are forwarded to the writer in this process, which publishes
+        # the updated model to the snapshot file; workers remap it.
+        writer = RatingWriter(holder, ldr, multiprocessing.get_context("fork").Queue())
+
+        def init_worker():
+            global ldr, scheduler
+            # Scheduler runs in the master only; connections must not be shared between processes
+            scheduler = None
+            ldr = PostgresLoader("postgres", "postgres", "rs_pg", 5432, "mydb")
+            SnapshotFollower(holder, args.snapshot, lambda: SVDBasedCF(70)).start()
+
+        pids = serve_workers(app, "0.0.0.0", int(args.port), args.workers, init_worker)
+        writer.start()
+        SnapshotPublisher(holder, args.snapshot, args.publish_interval).start()
+        if scheduler is not None:
+            scheduler.start()
+        if args.sync_interval is not None:
+            DeltaSync(holder, ldr, args.sync_interval).start()
+        try:
+            wait_workers(pids)
+        finally:
+            writer.stop()
+            ldr.close()
+    else:
+        writer = RatingWriter(holder, ldr)
+        writer.start()
+        if scheduler is not None:
+            scheduler.start()
+        if args.sync_interval is not None:
+            DeltaSync(holder, ldr, args.sync_interval).start()
+        try:
+            app.run("0.0.0.0", port=int(args.port), threaded=True)
+        finally:
+            # Ratings accepted before shutdown are written to the database
+            writer.stop()
+            ldr.close()
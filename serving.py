@@ -0,0 +1,351 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from common import ItemRating
+from common.snapshot import write_snapshot
+from recs import RecommenderEngine
+
+
+class ModelHolder:
+    """
+    Holds the engine that serves requests.
+    Request handlers read holder.engine once per request and use that instance; reading an attribute is atomic,
+    so readers never block and never see half-swapped model. Writers (rating updates and model swap) are serialized
+    with the lock.
+
+    Within the engine, single writer publishes changes by replacing objects rather than mutating them in place
+    (user vectors, index arrays), and interaction store publishes new records by bumping its size last.
+    So readers always see some consistent state without taking locks.
+    """
+    def __init__(self, engine: RecommenderEngine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.built_at = time.time()
+        self.ratings_at_build = len(engine.interactions)
+        # Incremented on every change of the model
+        self.version = 0
+
+    def apply_rating(self, user_id: str, item_id: str, rating: float, timestamp: int):
+        with self.lock:
+            self.engine.add_data(user_id, item_id, rating, timestamp)
+            self.engine.online_update_step(user_id, item_id)
+            self.version += 1
+
+    def apply_deltas(self, records: List[ItemRating]) -> int:
+        with self.lock:
+            applied = self.engine.apply_deltas(records)
+            if applied > 0:
+                self.version += 1
+        return applied
+
+    def swap(self, engine: RecommenderEngine, ratings_at_build: int):
+        """
+        Atomically replaces the engine. Ratings that old engine received after <ratings_at_build> are replayed
+        into the new one first. Must be called with the lock held.
+        """
+        old = self.engine.interactions
+        for pos in range(ratings_at_build, len(old)):
+            record = old.records([pos])[0]
+            engine.add_data(record.user_id, record.item_id, record.rating, record.timestamp)
+            engine.online_update_step(record.user_id, record.item_id)
+        self.engine = engine
+        self.built_at = time.time()
+        self.ratings_at_build = ratings_at_build
+        self.version += 1
+
+    def staleness(self) -> Dict[str, float]:
+        return {
+            "seconds_since_build": time.time() - self.built_at,
+            "ratings_since_build": len(self.engine.interactions) - self.ratings_at_build
+        }
+
+
+def _build_snapshot(engine_factory: Callable[[], RecommenderEngine], source: RecommenderEngine, size: int, path: str):
+    # Runs in forked process: source engine is inherited copy-on-write
+    engine = engine_factory()
+    engine.interactions.load_from(source.interactions, size)
+    engine.build()
+    engine.save(path)
+
+
+class RebuildScheduler(threading.Thread):
+    """
+    Periodically trains new engine instance from current ratings and swaps it into the holder.
+    Rebuild is triggered every <interval> seconds and/or after <min_new_ratings> new ratings.
+
+    In MODE_THREAD engine is built on this thread (heavy numpy/scipy parts release the GIL).
+    In MODE_PROCESS it is built in forked process and handed over through snapshot file in <snapshot_dir>,
+    so request handling does not compete with the build for the GIL at all. The new model is memory-mapped.
+    Caveat: the process is forked from a process that already runs threads (request handlers, rating writer, sync),
+    and only the forking thread survives in the child. A lock held by another thread at that moment (e.g. of logging
+    or of a native library's thread pool) stays locked in the child forever, and the build hangs. So MODE_THREAD is
+    the default, and MODE_PROCESS is opt-in for deployments that accept this risk.
+    """
+    MODE_THREAD = "thread"
+    MODE_PROCESS = "process"
+
+    def __init__(self, holder: ModelHolder, engine_factory: Callable[[], RecommenderEngine],
+                 interval: Optional[float] = None, min_new_ratings: Optional[int] = None,
+                 mode: str = MODE_THREAD, snapshot_dir: Optional[str] = None, check_period: float = 1.0):
+        super().__init__(daemon=True)
+        self.holder = holder
+        self.engine_factory = engine_factory
+        self.interval = interval
+        self.min_new_ratings = min_new_ratings
+        self.mode = mode
+        self.snapshot_dir = snapshot_dir if snapshot_dir is not None else tempfile.gettempdir()
+        self.check_period = check_period
+        self._stop_event = threading.Event()
+        self._retry_at = 0.0
+
+        # Metrics
+        self.rebuilds = 0
+        self.failures = 0
+        self.last_duration = None  # type: Optional[float]
+        self.last_finished_at = None  # type: Optional[float]
+
+    def due(self) -> bool:
+        staleness = self.holder.staleness()
+        if self.interval is not None and staleness["seconds_since_build"] >= self.interval:
+            return True
+        if self.min_new_ratings is not None and staleness["ratings_since_build"] >= self.min_new_ratings:
+            return True
+        return False
+
+    def _build(self, source: RecommenderEngine, size: int) -> RecommenderEngine:
+        if self.mode == self.MODE_PROCESS:
+            path = os.path.join(self.snapshot_dir, "rebuild-%d.snapshot" % os.getpid())
+            process = multiprocessing.get_context("fork").Process(
+                target=_build_snapshot, args=(self.engine_factory, source, size, path))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError("Rebuild process failed with exit code %s" % process.exitcode)
+            engine = self.engine_factory()
+            engine.load(path)
+            # Mapping stays valid after unlink, and next rebuild does not overwrite pages we use
+            os.remove(path)
+            return engine
+        engine = self.engine_factory()
+        engine.interactions.load_from(source.interactions, size)
+        engine.build()
+        return engine
+
+    def rebuild(self):
+        started = time.time()
+        source = self.holder.engine
+        size = len(source.interactions)
+        engine = self._build(source, size)
+        with self.holder.lock:
+            self.holder.swap(engine, size)
+        self.rebuilds += 1
+        self.last_finished_at = time.time()
+        self.last_duration = self.last_finished_at - started
+        print("Model rebuilt in %.1f s from %d ratings" % (self.last_duration, size))
+
+    def run(self):
+        while not self._stop_event.wait(self.check_period):
+            if time.time() < self._retry_at or not self.due():
+                continue
+            try:
+                self.rebuild()
+            except Exception:
+                self.failures += 1
+                logging.exception("Exception during rebuild")
+                # Postponing next attempt instead of retrying in a loop
+                self._retry_at = time.time() + (self.interval if self.interval is not None else 60.0)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def metrics(self) -> Dict[str, Optional[float]]:
+        metrics = {
+            "rebuilds": self.rebuilds,
+            "rebuild_failures": self.failures,
+            "last_rebuild_duration": self.last_duration,
+            "last_rebuild_finished_at": self.last_finished_at
+        }
+        metrics.update(self.holder.staleness())
+        return metrics
+
+
+class RatingWriter(threading.Thread):
+    """
+    The only writer of the model: applies rating events from the queue to the database and to the model, in order.
+    Request handlers just submit events, so they never wait for database or model updates.
+    Queue may be multiprocessing.Queue, so worker processes can submit events to the writer in the master process.
+    """
+    def __init__(self, holder: ModelHolder, loader, events=None):
+        super().__init__(daemon=True)
+        self.holder = holder
+        self.loader = loader
+        self.events = events if events is not None else queue.Queue()
+        self.applied = 0
+
+    def submit(self, user_id: str, item_id: str, rating: float, timestamp: int):
+        self.events.put((user_id, item_id, rating, timestamp))
+
+    def run(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            user_id, item_id, rating, timestamp = event
+            try:
+                self.loader.put_record(item_id, user_id, rating, timestamp)
+                self.holder.apply_rating(user_id, item_id, rating, timestamp)
+                self.applied += 1
+            except Exception:
+                logging.exception("Exception during applying rating")
+
+    def stop(self):
+        self.events.put(None)
+        self.join()
+
+
+class DeltaSync(threading.Thread):
+    """
+    Periodically pulls ratings that other processes wrote to the database since the model's watermark,
+    and applies them to the held model. Each refresh costs O(new ratings).
+    Watermark is moved back by <overlap> seconds, to catch ratings that were committed late; duplicates are skipped.
+    """
+    def __init__(self, holder: ModelHolder, loader, interval: float = 10.0, overlap: int = 5):
+        super().__init__(daemon=True)
+        self.holder = holder
+        self.loader = loader
+        self.interval = interval
+        self.overlap = overlap
+        self.applied = 0
+
+    def sync(self) -> int:
+        watermark = self.holder.engine.watermark
+        if watermark is not None:
+            watermark -= self.overlap
+        # Fetching outside of the lock: the writer is not blocked by the database
+        records = list(self.loader.get_records_since(watermark))
+        applied = self.holder.apply_deltas(records)
+        self.applied += applied
+        return applied
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sync()
+            except Exception:
+                logging.exception("Exception during delta sync")
+
+
+class SnapshotPublisher(threading.Thread):
+    """
+    Periodically saves the model held by <holder> to snapshot file, if it has changed.
+    Worker processes follow this file (see SnapshotFollower), so they see changes after up to <interval> seconds
+    plus the time of writing the file.
+    Model state is copied under the holder's lock, and written after it is released, so the rating writer and
+    rebuild swaps are only blocked for the copy.
+    """
+    def __init__(self, holder: ModelHolder, path: str, interval: float = 60.0):
+        super().__init__(daemon=True)
+        self.holder = holder
+        self.path = path
+        self.interval = interval
+        self.published_version = holder.version
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            if self.holder.version == self.published_version:
+                continue
+            try:
+                with self.holder.lock:
+                    version = self.holder.version
+                    arrays, meta = self.holder.engine.snapshot_state(copy=True)
+                write_snapshot(self.path, arrays, meta)
+                self.published_version = version
+            except Exception:
+                logging.exception("Exception during publishing snapshot")
+
+
+class SnapshotFollower(threading.Thread):
+    """
+    Reloads the engine in worker process when snapshot file is replaced, and swaps it into the holder.
+    Snapshots are memory-mapped, so all workers share the same physical pages of model arrays.
+    """
+    def __init__(self, holder: ModelHolder, path: str, engine_factory: Callable[[], RecommenderEngine],
+                 check_period: float = 1.0):
+        super().__init__(daemon=True)
+        self.holder = holder
+        self.path = path
+        self.engine_factory = engine_factory
+        self.check_period = check_period
+        self._stat = self._current_stat()
+
+    def _current_stat(self):
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime
+
+    def run(self):
+        while True:
+            time.sleep(self.check_period)
+            try:
+                stat = self._current_stat()
+                if stat == self._stat:
+                    continue
+                engine = self.engine_factory()
+                engine.load(self.path)
+                self.holder.engine = engine
+                self.holder.built_at = time.time()
+                self._stat = stat
+            except Exception:
+                logging.exception("Exception during reloading snapshot")
+
+
+def serve_workers(app, host: str, port: int, workers: int, init_worker: Callable[[], None]) -> List[int]:
+    """
+    Forks <workers> processes that serve <app> on shared listening socket. The caller should load the model
+    (preferably memory-mapped) before the call, so workers share it. Returns pids of workers.
+    """
+    from werkzeug.serving import make_server
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                init_worker()
+                make_server(host, port, app, threaded=True, fd=sock.fileno()).serve_forever()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    sock.close()
+    return pids
+
+
+def wait_workers(pids: List[int]):
+    """
+    Waits for worker processes; on SIGTERM/SIGINT terminates them
+    """
+    def terminate(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    for pid in pids:
+        os.waitpid(pid, 0)
@@ -1,17 +1,20 @@
+import os
 import random
-from collections import Counter
 
 import numpy as np
 
 from evaluator import TimeBasedEvaluator
 from loader import MovieLensLoader
-from recs import SVDBasedCF, AverageRatingRecs, ANNRecs
+from recs import SVDBasedCF, AverageRatingRecs, ItemCF
+from recs.ann_recs import ANNRecs
 from recs.user_cf import UserBasedNNCF
+from recs.factorization import CachedPrefixFactorization, RandomizedSVDFactorization
+from search import HyperparameterSearch
 import argparse
 
 random.seed(42)
-ldr = MovieLensLoader("data/movielens/", 500000)
-ev = TimeBasedEvaluator(ldr, [("train", 0.7), ("valid", 0.15), ("test", 0.15)])
+ldr = MovieLensLoader("data/movielens/", 500000, cache=True)
+ev = TimeBasedEvaluator(ldr, [("train", 0.7), ("valid", 0.15), ("test", 0.15)], n_jobs=os.cpu_count())
 
 
 def squared_error(a, b):
@@ -21,49 +24,57 @@ def squared_error(a, b):
 def absolute_error(a, b):
     return np.abs((a - b))
 
+SVD_COMPONENTS = list(range(10, 190, 15))
+
+def ann_params(last_layer_size, lr):
+    return {"item_embedding_size": last_layer_size * 2,
+            "user_embedding_size": last_layer_size * 2,
+            "dense_sizes": [last_layer_size * 4, last_layer_size * 2, last_layer_size],
+            "lr": lr
+            }
+
 def cv_ann():
     print("ANN CV")
-    cv_results_ann = Counter()
-    ann_param_map = {}
-    i = 0
-    for last_layer_size in [8, 16, 32, 64]:
-        for lr in [0.0001, 0.0005, 0.001, 0.005]:
-            i += 1
-            params = {"item_embedding_size": last_layer_size * 2,
-                      "user_embedding_size": last_layer_size * 2,
-                      "dense_sizes": [last_layer_size * 4, last_layer_size * 2, last_layer_size],
-                      "lr": lr
-                      }
-            recs = ANNRecs(**params, epochs=50)
-            score = ev.evaluate_scoring(recs,
-                                        scorers=[squared_error, absolute_error], test_partitions=["valid"])
-            print("ANN (%d %f) %f %f" % (last_layer_size, lr, score[0], score[1]))
-            cv_results_ann[i] = -score[0]
-            ann_param_map[i] = params
-    return ann_param_map[cv_results_ann.most_common(1)[0][0]]
+    # Successive halving by number of epochs. TensorFlow does not survive fork, so grid points run one by one.
+    search = HyperparameterSearch("ann", ev, lambda p, epochs: ANNRecs(**ann_params(*p), epochs=int(epochs)),
+                                  scorers=[squared_error, absolute_error], cache_path=args.cv_cache)
+    results = search.run([(size, lr) for size in [8, 16, 32, 64] for lr in [0.0001, 0.0005, 0.001, 0.005]],
+                         budgets=[6, 17, 50], eta=3)
+    for (last_layer_size, lr), score in results:
+        print("ANN (%d %f) %f %f" % (last_layer_size, lr, score[0], score[1]))
+    return ann_params(*results[0][0])
 
 def cv_cf():
     print("Performing CV for UserBasedCF")
-    cv_results_user_based = Counter()
-    for n in [3, 5, 7, 10, 15, 20]:
-        for correction in [UserBasedNNCF.CORRECTION_USER_MEAN, UserBasedNNCF.CORRECTION_NONE]:
-            for prediction in [UserBasedNNCF.PREDICTION_AVERAGE, UserBasedNNCF.PREDICTION_UNBIASED_AVERAGE]:
-                score = ev.evaluate_scoring(UserBasedNNCF(n, correction, prediction, n * 2),
-                                            scorers=[squared_error, absolute_error], test_partitions=["valid"])
-                print("UserCF(", n, correction, prediction, ")", score)
-                cv_results_user_based[(n, correction, prediction)] = -score[0]
-    return cv_results_user_based.most_common(1)[0][0]
-
-def cv_svd():
+    search = HyperparameterSearch("user_cf", ev, lambda p, budget: UserBasedNNCF(p[0], p[1], p[2], p[0] * 2),
+                                  scorers=[squared_error, absolute_error], cache_path=args.cv_cache,
+                                  n_jobs=args.cv_jobs)
+    results = search.run([(n, correction, prediction) for n in [3, 5, 7, 10, 15, 20]
+                          for correction in [UserBasedNNCF.CORRECTION_USER_MEAN, UserBasedNNCF.CORRECTION_NONE]
+                          for prediction in [UserBasedNNCF.PREDICTION_AVERAGE,
+                                             UserBasedNNCF.PREDICTION_UNBIASED_AVERAGE]])
+    for params, score in results:
+        print("UserCF(", *params, ")", score)
+    return results[0][0]
+
+def svd_factorization():
+    # Train matrix is the same for every grid point, so we factorize it once and reuse truncated prefixes
+    return CachedPrefixFactorization(RandomizedSVDFactorization(n_jobs=2), max(SVD_COMPONENTS))
+
+def cv_svd(factorization):
     print("Performing CV for SVD")
-    cv_results_svd = Counter()
-    for i in range(10, 190, 15):
-        score = ev.evaluate_scoring(SVDBasedCF(i), scorers=[squared_error, absolute_error], test_partitions=["valid"])
-        print("SVD(", i, ")", score)
-        cv_results_svd[i] = -score[0]  # Using MSE score to make final decision
-    return cv_results_svd.most_common(1)[0][0]
-
-def main(do_cf, do_svd, do_ann):
+    components = SVD_COMPONENTS
+    search = HyperparameterSearch("svd", ev, lambda c, budget: SVDBasedCF(c, factorization=factorization),
+                                  scorers=[squared_error, absolute_error], cache_path=args.cv_cache,
+                                  n_jobs=args.cv_jobs, threads_per_job=2)
+    # Factorizing before workers are forked, so they inherit cached factors
+    search.make_engine(max(components)).build()
+    results = search.run(components)
+    for i, score in results:
+        print("SVD(", i, ")", score)  # Sorted by MSE, which is used to make final decision
+    return results[0][0]
+
+def main(do_cf, do_svd, do_ann, do_itemcf):
     final_eval_params = {
         "scorers": [squared_error, absolute_error],
         "train_partitions": ["train", "valid"],
@@ -71,11 +82,16 @@ def main(do_cf, do_svd, do_ann):
     }
     print("=" * 10, "Final scores", "=" * 10)
     print("Average rating recs", ev.evaluate_scoring(AverageRatingRecs(), **final_eval_params))
+    if do_itemcf:
+        print("Item-based CF", ev.evaluate_scoring(ItemCF(), **final_eval_params))
 
     if do_svd:
-        best_params = cv_svd()
+        # Final model uses the same factorization backend as the one the number of components was selected with
+        factorization = svd_factorization()
+        best_params = cv_svd(factorization)
         print("=" * 10, "Final scores", "=" * 10)
-        print("SVD(", best_params, ")", ev.evaluate_scoring(SVDBasedCF(best_params), **final_eval_params))
+        print("SVD(", best_params, ")", ev.evaluate_scoring(SVDBasedCF(best_params, factorization=factorization),
+                                                            **final_eval_params))
 
     if do_cf:
         best_params = cv_cf()
@@ -104,6 +120,13 @@ if __name__ == "__main__":
                         help="Do not evaluate used-based collaborative filtering")
     parser.add_argument("--skip_svd", type=str2bool, nargs='?', const=True, default="no",
                         help="Do not evaluate SVD-based recommender")
+    parser.add_argument("--skip_itemcf", type=str2bool, nargs='?', const=True, default="no",
+                        help="Do not evaluate item-based collaborative filtering")
+    parser.add_argument("--cv_jobs", type=int, default=max(1, os.cpu_count() // 2),
+                        help="Number of processes for cross-validation")
+    parser.add_argument("--cv_cache", default=None,
+                        help="File with cross-validation results (e.g. data/cv_results.jsonl); interrupted sweeps "
+                             "resume from it. Results of changed engine code are not detected: remove the file then")
     (args) = parser.parse_args()
 
-    main(not args.skip_cf, not args.skip_svd, not args.skip_ann)
+    main(not args.skip_cf, not args.skip_svd, not args.skip_ann, not args.skip_itemcf)